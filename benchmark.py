@@ -0,0 +1,481 @@
+#!/usr/bin/python
+#
+# Micro-benchmarks for the hot paths of the access log processing
+#
+# Usage
+#   benchmark.py [options] {benchmark} {access log}...
+#
+# Each benchmark runs the current implementation next to the one it replaced on the same log entries, checks that both
+# produce the same results and reports the entries per second of each. The stages benchmark instead times each stage of
+# the pipeline on its own, and the whole of it as main runs it. Results and the peak memory use can be written as JSON
+# and compared with those of an earlier run. loggen.py writes logs that give the same results on every machine.
+
+import datetime
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import timeit
+import logging
+import multiprocessing
+import operator
+import subprocess
+import cPickle as pickle # Changed to "pickle" in Python 3
+
+from optparse import OptionParser
+
+import re
+
+import reader
+import transaction
+
+import main as httpdnlyzr
+
+from main import logFile, getRecordFields, getLogParser, parseLogEntries, scanLogEntries, getStats, transactionGenerator, writePageviewPlotData, writePageviewsByDayPlotData
+from profile import Tree, Node, PathCollapser
+from stats import Stats
+from columnar import ColumnarStats
+from ring import RecordRing
+
+logger = logging.getLogger('benchmark')
+
+# What report has printed, for writing as JSON
+results = []
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] {" + "|".join(sorted(benchmarks)) + "} {access log}...")
+    parser.add_option("-l", "--lines", dest="lines", type="int", default=200000, help="Maximum number of log entries to read from the access logs")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3, help="Number of timing runs; the best one is reported")
+    parser.add_option("-b", "--batch", dest="batchSize", type="int", default=5000, help="Number of log entries in each batch of records the stages benchmark pickles, as main's -b")
+    parser.add_option("-o", "--output", dest="output", help="Write the results and peak memory use as JSON to this file")
+    parser.add_option("-B", "--baseline", dest="baseline", help="Compare the results with those of an earlier run written with -o")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2 or not args[0] in benchmarks:
+        parser.error("A benchmark and at least one access log are required")
+
+    benchmarks[args[0]](args[1:], options)
+
+    peakRSS = {'benchmark': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        , 'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+    print "Peak RSS: %(benchmark)d MB, %(children)d MB in child processes" % peakRSS
+
+    run = {'benchmark': args[0]
+        , 'accessLogs': args[1:]
+        , 'lines': options.lines
+        , 'date': datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        , 'python': platform.python_version()
+        , 'cpus': multiprocessing.cpu_count()
+        , 'peakRSSMB': peakRSS
+        , 'results': results}
+
+    if options.baseline:
+        compareRuns(run, options.baseline)
+
+    if options.output:
+        with open(options.output, "w") as outputFileHandle:
+            json.dump(run, outputFileHandle, indent=2, sort_keys=True)
+        print "Wrote the results to %s" % options.output
+
+# Prints the speed of each result relative to the result of the same name in a baseline run
+def compareRuns(run, baselinePath):
+    with open(baselinePath) as baselineFileHandle:
+        baseline = json.load(baselineFileHandle)
+
+    if baseline['benchmark'] != run['benchmark'] or baseline['accessLogs'] != run['accessLogs']:
+        print "The baseline is of %s on %s" % (baseline['benchmark'], ", ".join(baseline['accessLogs']))
+
+    print "Compared with %s of %s" % (baselinePath, baseline['date'])
+    baselineResults = dict((r['name'], r) for r in baseline['results'])
+    for result in results:
+        baselineResult = baselineResults.get(result['name'])
+        if baselineResult:
+            print "  %s %12s %12s entries per second (%.2fx)" % (result['name'].ljust(40), "{:,}".format(baselineResult['entriesPerSecond']), "{:,}".format(result['entriesPerSecond']), float(result['entriesPerSecond']) / baselineResult['entriesPerSecond'])
+        else:
+            print "  %s not in the baseline" % result['name']
+
+    for process in ('benchmark', 'children'):
+        print "  Peak RSS of the %s %d MB, %d MB in the baseline" % ("benchmark" if process == 'benchmark' else "child processes", run['peakRSSMB'][process], baseline['peakRSSMB'][process])
+
+def readLines(accessLogPaths, limit):
+    lines = []
+    for accessLogPath in accessLogPaths:
+        logFileHandle = logFile(accessLogPath)
+        for line in logFileHandle:
+            lines.append(line.rstrip())
+            if len(lines) >= limit:
+                break
+        logFileHandle.close()
+
+        if len(lines) >= limit:
+            break
+
+    print "Read %d log entries" % len(lines)
+    return lines
+
+def report(name, count, seconds, baseline=None):
+    speedup = "" if not baseline else " (%.1fx)" % (baseline / seconds)
+    print "  %s %12s entries per second%s" % (name.ljust(40), "{:,}".format(int(count / seconds)), speedup)
+    results.append({'name': name, 'entries': count, 'seconds': seconds, 'entriesPerSecond': int(count / seconds)})
+
+def bestOf(repeat, function):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def benchmarkDates(accessLogPaths, options):
+    lines = readLines(accessLogPaths, options.lines)
+    dates = [m.group('date') for m in map(transaction.logExpression.match, lines) if m]
+
+    for date in dates:
+        if transaction.parseDate(date) != datetime.datetime.strptime(date, transaction.dateFormat):
+            raise AssertionError("parseDate and strptime disagree on %s" % date)
+
+    print "Decoding %d timestamps" % len(dates)
+    strptimeTime = bestOf(options.repeat, lambda: [datetime.datetime.strptime(d, transaction.dateFormat) for d in dates])
+    report("datetime.strptime", len(dates), strptimeTime)
+
+    def parseDates():
+        transaction.minuteCache.clear()
+        [transaction.parseDate(d) for d in dates]
+    report("transaction.parseDate", len(dates), bestOf(options.repeat, parseDates), strptimeTime)
+
+# Reads every line of the compressed logs, as the log readers do, with the gunzip command and with the threaded reader
+def benchmarkDecompression(accessLogPaths, options):
+    compressedPaths = [p for p in accessLogPaths if p.endswith('.gz')]
+
+    def gunzip():
+        count = 0
+        for path in compressedPaths:
+            for line in subprocess.Popen(["gunzip", "--stdout", path], shell=False, bufsize=-1, stdout=subprocess.PIPE).stdout:
+                line.rstrip()
+                count += 1
+        return count
+
+    def decompress():
+        count = 0
+        for path in compressedPaths:
+            for line in reader.openCompressed(path):
+                line.rstrip()
+                count += 1
+        return count
+
+    count = gunzip()
+    if decompress() != count:
+        raise AssertionError("gunzip and reader.DecompressingReader read a different number of lines")
+
+    print "Reading %d log entries from %d compressed logs" % (count, len(compressedPaths))
+    gunzipTime = bestOf(options.repeat, gunzip)
+    report("gunzip --stdout", count, gunzipTime)
+    report("reader.DecompressingReader", count, bestOf(options.repeat, decompress), gunzipTime)
+
+# Collapses the resource paths of the log entries, as the request tree does, by trying each path pattern in turn and with
+# the combined, cached matcher
+def benchmarkPaths(accessLogPaths, options):
+    lines = readLines(accessLogPaths, options.lines)
+    queryStart = re.compile('\?')
+    paths = [queryStart.split(m.group('path'), maxsplit=1)[0] for m in map(transaction.logExpression.match, lines) if m]
+    sitePathREPatterns = [(re.compile("^%s$" % Tree.getPathRE(p)), p) for p in Tree.pathPatterns]
+
+    def collapseEach(path):
+        for c in sitePathREPatterns:
+            if c[0].match(path):
+                return c[1]
+        return Tree.idPattern.sub("*", path)
+
+    pathCollapser = PathCollapser(Tree.pathPatterns)
+    for path in paths:
+        if pathCollapser.collapse(path) != collapseEach(path):
+            raise AssertionError("The path patterns and PathCollapser disagree on %s" % path)
+
+    print "Collapsing %d paths, %d distinct" % (len(paths), len(set(paths)))
+    eachTime = bestOf(options.repeat, lambda: [collapseEach(p) for p in paths])
+    report("Each path pattern in turn", len(paths), eachTime)
+    report("PathCollapser.match", len(paths), bestOf(options.repeat, lambda: [pathCollapser.match(p) for p in paths]), eachTime)
+
+    def collapse():
+        cachingCollapser = PathCollapser(Tree.pathPatterns)
+        [cachingCollapser.collapse(p) for p in paths]
+    report("PathCollapser.collapse", len(paths), bestOf(options.repeat, collapse), eachTime)
+
+# Inserts the log entries into a request tree, by recursing with a slice of the path per step as Tree.addLeaf did, and
+# with Tree.addLeaf
+def benchmarkTree(accessLogPaths, options):
+    lines = readLines(accessLogPaths, options.lines)
+    transactions = [t for t in [transaction.Transaction(l, "node") for l in lines] if t.isValid() and not t.isError()]
+    queryStart = re.compile('\?')
+    pathDelimiter = re.compile('/+')
+    pathCollapser = PathCollapser(Tree.pathPatterns)
+    paths = [tuple([intern(s) for s in pathDelimiter.split(pathCollapser.collapse(queryStart.split(t.path, maxsplit=1)[0]))[1:]]) for t in transactions]
+
+    class EmptyTree(Tree):
+        def __init__(self):
+            self.root = Node("")
+            self.leaves = []
+
+    def addLeafRecursively(tree, parent, path, transaction):
+        if len(path) > 0:
+            parent.incrementExecutions(transaction.time)
+
+            step = path[0]
+
+            children = parent.getChildren()
+            if children.has_key(step):
+                thisNode = children[step]
+            else:
+                thisNode = Node(parent.path + "/" + step)
+                children[step] = thisNode
+
+            addLeafRecursively(tree, thisNode, path[1:], transaction)
+        else:
+            if parent.getReads() == 0:
+                tree.leaves.append(parent)
+                parent.setTransaction(transaction)
+            parent.incrementReads(transaction.time)
+
+    def recurse():
+        tree = EmptyTree()
+        for t, path in zip(transactions, paths):
+            addLeafRecursively(tree, tree.root, list(path), t)
+        return tree
+
+    def iterate():
+        tree = EmptyTree()
+        for t, path in zip(transactions, paths):
+            tree.addLeaf(tree.root, path, t)
+        return tree
+
+    def describe(node):
+        children = sorted(node.getChildren().items())
+        return (node.path, node.reads, node.executions, node.readTime, node.executionTime, node.method, node.status, node.contentType, [(s, describe(c)) for s, c in children])
+
+    recursiveTree = recurse()
+    iterativeTree = iterate()
+    if describe(recursiveTree.root) != describe(iterativeTree.root) or [l.path for l in recursiveTree.leaves] != [l.path for l in iterativeTree.leaves]:
+        raise AssertionError("The recursive and iterative insertions built different trees")
+
+    print "Inserting %d transactions, %d steps deep on average" % (len(paths), sum(map(len, paths)) / max(len(paths), 1))
+    recursiveTime = bestOf(options.repeat, recurse)
+    report("Recursive insertion", len(paths), recursiveTime)
+    report("Tree.addLeaf", len(paths), bestOf(options.repeat, iterate), recursiveTime)
+
+# Parses the log entries with every field, as the transaction cache does, and with the lean parser of each mode, and
+# checks that the lean parsers give the same values for the fields they parse
+def benchmarkParsers(accessLogPaths, options):
+    lines = readLines(accessLogPaths, options.lines)
+    modes = [("pageviews", getLogParser(getRecordFields(False), None, None))
+        , ("pageviews matching paths", getLogParser(getRecordFields(False), re.compile(".*"), None))
+        , ("request tree", getLogParser(getRecordFields(True), None, None))
+    ]
+
+    def parse(parser):
+        return [transaction.Transaction(l, "node", parser) for l in lines]
+
+    fullTransactions = parse(transaction.fullParser)
+    for name, parser in modes:
+        for full, lean in zip(fullTransactions, parse(parser)):
+            if full.isValid() != lean.isValid() or lean.isValid() and [getattr(full, f) for f in parser.fields] != [getattr(lean, f) for f in parser.fields]:
+                raise AssertionError("The full and %s parsers disagree on %s" % (name, full.getRaw()))
+
+    del fullTransactions
+
+    print "Parsing %d log entries" % len(lines)
+    fullTime = bestOf(options.repeat, lambda: parse(transaction.fullParser))
+    report("every field", len(lines), fullTime)
+    for name, parser in modes:
+        report(name, len(lines), bestOf(options.repeat, lambda: parse(parser)), fullTime)
+
+# Reads and parses the uncompressed logs with the pageview parser, line by line as compressed logs are and by scanning the
+# memory mapped files, and checks that both give the same transactions
+def benchmarkScan(accessLogPaths, options):
+    uncompressedPaths = [p for p in accessLogPaths if not reader.isCompressed(p)]
+    logParser = getLogParser(getRecordFields(False), None, None)
+
+    def parseLines():
+        return [t for p in uncompressedPaths for t in parseLogEntries(itertools.islice(logFile(p), options.lines), p, logParser, None, None, None)]
+
+    def scan():
+        return [t for p in uncompressedPaths for t in itertools.islice(scanLogEntries(p, 0, None, p, logParser, None, None, None), options.lines)]
+
+    lineTransactions = parseLines()
+    scannedTransactions = scan()
+    def describe(t):
+        return (t.isValid(), t.getRaw(), t.getNode()) + tuple([getattr(t, f, None) for f in logParser.fields])
+    if map(describe, lineTransactions) != map(describe, scannedTransactions):
+        raise AssertionError("Parsing line by line and scanning gave different transactions")
+
+    count = len(lineTransactions)
+    del lineTransactions, scannedTransactions
+
+    print "Reading and parsing %d log entries from %d uncompressed logs" % (count, len(uncompressedPaths))
+    linesTime = bestOf(options.repeat, parseLines)
+    report("line by line", count, linesTime)
+    report("scanLogEntries", count, bestOf(options.repeat, scan), linesTime)
+
+# Aggregates the log entries of each access log as one node, with Stats and with ColumnarStats, and checks that every
+# minute, hour and day has the same stats in both
+def benchmarkEngines(accessLogPaths, options):
+    if not ColumnarStats.isAvailable():
+        raise AssertionError("NumPy must be installed to compare the engines")
+
+    batches = []
+    for accessLogPath in accessLogPaths:
+        transactions = [transaction.Transaction(l.rstrip(), accessLogPath) for l in itertools.islice(logFile(accessLogPath), options.lines)]
+        batches.append((accessLogPath, [t for t in transactions if t.isValid()]))
+    count = sum([len(b[1]) for b in batches])
+    records = [(node, [ColumnarStats.getRecord(t) for t in transactions]) for node, transactions in batches]
+
+    def aggregate():
+        stats = {}
+        for node, transactions in batches:
+            stats[node] = Stats()
+            for t in transactions:
+                stats[node].agg(t)
+
+        aggStats = Stats()
+        for node in stats:
+            aggStats.aggNode(node, stats[node])
+        return aggStats
+
+    getters = ['getDate', 'getTransactionCount', 'getUserviewCount', 'getAPITransactionCount', 'getApiviewCount', 'getPageviewCount', 'getAuthErrorCount', 'getServErrorCount', 'getUserviewAvgTime', 'getAsyncviewAvgTime', 'get95PercentileUserviewTime', 'get95PercentileAsyncviewTime', 'get90PercentileUserviewTime', 'get90PercentileAsyncviewTime', 'getStdDevUserviewTime']
+
+    def compare(name, instants, summaries):
+        if len(instants) != len(summaries):
+            raise AssertionError("Stats has %d %s and ColumnarStats %d" % (len(instants), name, len(summaries)))
+        for instant, summary in zip(instants, summaries):
+            for getter in getters:
+                expected = getattr(instant, getter)()
+                actual = getattr(summary, getter)()
+                if expected != actual and not (isinstance(expected, float) and abs(expected - actual) <= 1e-9 * abs(expected)):
+                    raise AssertionError("%s of %s differs: %r and %r" % (getter, instant.getDate(), expected, actual))
+
+    stats = aggregate()
+    columnarStats = ColumnarStats.fromBatches(records)
+    for name, s, c in [("aggregate", stats, columnarStats)] + [(node, stats.getNode(node), columnarStats.getNode(node)) for node in sorted(stats.getAllNodes())]:
+        compare(name + " minutes", s.getMinutes(None, None), c.getMinutes(None, None))
+        compare(name + " hours", s.getHours(None, None), c.getHours(None, None))
+        compare(name + " days", s.getDays(None, None), c.getDays(None, None))
+    print "Stats and ColumnarStats agree on every minute, hour and day"
+
+    def summarize(stats):
+        [(m.get95PercentileUserviewTime(), m.getStdDevUserviewTime()) for m in stats.getMinutes(None, None)]
+        [h.getPageviewCount() for h in stats.getHours(None, None)]
+        [d.getPageviewCount() for d in stats.getDays(None, None)]
+
+    print "Aggregating %d transactions from %d nodes" % (count, len(batches))
+    statsTime = bestOf(options.repeat, lambda: summarize(aggregate()))
+    report("Stats", count, statsTime)
+    report("ColumnarStats", count, bestOf(options.repeat, lambda: summarize(ColumnarStats.fromBatches(records))), statsTime)
+
+# Times each stage of the pipeline over every entry of the access logs, one after another in this process: reading and
+# decompressing, parsing with the pageview parser, pickling and unpickling the batches of records the log readers send
+# or sending them through a ring buffer, aggregating the records into Stats, building the request tree, and writing the
+# plot data. Before that, main is run over the same logs in child processes, with the transaction queue and with ring
+# buffers, without the record cache and without plotting since gnuplot's rendering isn't part of the pipeline. Its peak
+# memory use is that of the child processes. -l is ignored; the logs are read in full so that the stages read what main
+# does.
+def benchmarkStages(accessLogPaths, options):
+    workDir = tempfile.mkdtemp(prefix="benchmark")
+    try:
+        runStages(accessLogPaths, options, workDir)
+    finally:
+        shutil.rmtree(workDir)
+
+def runStages(accessLogPaths, options, workDir):
+    # main reads every log in the directories it's given, so it's given directories of links to the access logs. The
+    # log readers take each directory for a node.
+    logDirs = []
+    for accessLogPath in accessLogPaths:
+        logDir = os.path.join(workDir, "node%d" % sorted(set(map(os.path.dirname, accessLogPaths))).index(os.path.dirname(accessLogPath)))
+        if not os.path.isdir(logDir):
+            os.makedirs(logDir)
+            logDirs.append(logDir)
+        os.symlink(os.path.abspath(accessLogPath), os.path.join(logDir, os.path.basename(accessLogPath)))
+
+    outputDir = os.path.join(workDir, "output")
+    os.makedirs(outputDir)
+
+    def runMain(extraArgs):
+        sys.argv = ["main.py", "-f", "-n", "-q", "-C", "0", "-w", outputDir] + extraArgs + logDirs
+        sys.stdout = open(os.devnull, "w")
+        httpdnlyzr.plotPageviews = lambda plotInfo, options, dataFilePath: None
+        httpdnlyzr.main()
+
+    def endToEnd(extraArgs=[]):
+        process = multiprocessing.Process(target=runMain, args=(extraArgs,))
+        process.start()
+        process.join()
+        if process.exitcode:
+            raise AssertionError("main exited with %d" % process.exitcode)
+
+    def read():
+        return [(os.path.dirname(p), list(logFile(p))) for p in accessLogPaths]
+
+    logFiles = read()
+    count = sum([len(lines) for node, lines in logFiles])
+    print "Running the pipeline on %d log entries from %d access logs" % (count, len(accessLogPaths))
+    report("end to end (main)", count, bestOf(options.repeat, endToEnd))
+    report("end to end (main -R)", count, bestOf(options.repeat, lambda: endToEnd(["-R"])))
+    report("read and decompress", count, bestOf(options.repeat, read))
+
+    recordFields = getRecordFields(False)
+    logParser = getLogParser(recordFields, None, None)
+    def parse(parser):
+        return [(node, [transaction.Transaction(l.rstrip(), node, parser) for l in lines]) for node, lines in logFiles]
+    report("parse", count, bestOf(options.repeat, lambda: parse(logParser)))
+
+    # Batches of records as the log readers send them
+    def getBatches(parsedLogFiles, fields):
+        getRecord = operator.attrgetter(*fields)
+        batches = []
+        for node, transactions in parsedLogFiles:
+            for i in range(0, len(transactions), options.batchSize):
+                batch = transactions[i:i + options.batchSize]
+                batches.append((node, [getRecord(t) for t in batch if t.isValid()], len(batch), [], 0, 0))
+        return batches
+
+    batches = getBatches(parse(logParser), recordFields)
+    report("transport (pickle)", count, bestOf(options.repeat, lambda: [pickle.loads(pickle.dumps(b, pickle.HIGHEST_PROTOCOL)) for b in batches]))
+
+    # Each batch is written to a slot and read back at once, so a ring of one slot will do
+    ring = RecordRing(0, recordFields, options.batchSize, 1)
+    def sendThroughRing():
+        for b in batches:
+            ringBatch = ring.write(ring.acquireSlot(), b[1])
+            pickle.loads(pickle.dumps((b[0], ringBatch) + b[2:], pickle.HIGHEST_PROTOCOL))
+            ring.read(ringBatch)
+    if [r for b in batches for r in ring.read(ring.write(ring.acquireSlot(), b[1]))] != [r for b in batches for r in b[1]]:
+        raise AssertionError("The records read from the ring differ from those written to it")
+    report("transport (ring)", count, bestOf(options.repeat, sendThroughRing))
+
+    statsBatches = [(b[0], b[1]) for b in batches]
+    report("Stats.agg", count, bestOf(options.repeat, lambda: getStats(transactionGenerator(statsBatches, recordFields))))
+    stats = getStats(transactionGenerator(statsBatches, recordFields))
+
+    treeFields = getRecordFields(True)
+    treeBatches = [(b[0], b[1]) for b in getBatches(parse(getLogParser(treeFields, None, None)), treeFields)]
+    report("Tree build", count, bestOf(options.repeat, lambda: Tree(transactionGenerator(treeBatches, treeFields), "", None, None)))
+
+    def writePlotData():
+        hours = stats.getPeakHours(8)
+        startDate = hours[0].getDate()
+        stopDate = hours[-1].getDate() + datetime.timedelta(hours=1)
+        writePageviewPlotData(hours, stats.getMinutes(startDate, stopDate), startDate, stopDate, os.path.join(outputDir, "pageviews.dat"), True)
+        writePageviewsByDayPlotData(stats, None, None, os.path.join(outputDir, "pageviews_by_day"), "Benchmark")
+    report("plot data", count, bestOf(options.repeat, writePlotData))
+
+benchmarks = {'dates': benchmarkDates
+    , 'decompression': benchmarkDecompression
+    , 'paths': benchmarkPaths
+    , 'tree': benchmarkTree
+    , 'parsers': benchmarkParsers
+    , 'engines': benchmarkEngines
+    , 'scan': benchmarkScan
+    , 'stages': benchmarkStages
+}
+
+if __name__ == "__main__":
+    main()
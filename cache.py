@@ -0,0 +1,185 @@
+#!/usr/bin/python
+import array
+import datetime
+import itertools
+import logging
+import marshal
+import md5
+import os
+
+from transaction import Transaction
+
+logger = logging.getLogger('cache')
+
+# Keeps the parsed transactions of each compressed access log in the working directory so they needn't be decompressed
+# and parsed again. A cache file is only used while the path, size and modification time of its log file are unchanged.
+# The least recently used cache files are removed once the cache grows beyond its size limit.
+class RecordCache:
+    version = 1
+    extension = ".rec"
+
+    def __init__(self, cacheDir, sizeLimit):
+        self.cacheDir = cacheDir
+        self.sizeLimit = sizeLimit
+
+        if not os.path.isdir(cacheDir):
+            try:
+                os.makedirs(cacheDir)
+            except OSError:
+                pass # Another log reader created it
+
+    def getCachePath(self, accessLogPath):
+        return os.path.join(self.cacheDir, md5.new(os.path.abspath(accessLogPath)).hexdigest() + RecordCache.extension)
+
+    @staticmethod
+    def getKey(accessLogPath, stat):
+        return [os.path.abspath(accessLogPath), stat.st_size, int(stat.st_mtime)]
+
+    # Whether the transactions of a log file are cached and up to date
+    def isCached(self, accessLogPath):
+        try:
+            with open(self.getCachePath(accessLogPath), 'rb') as cacheFileHandle:
+                version, key = marshal.load(cacheFileHandle)
+            return version == RecordCache.version and key == RecordCache.getKey(accessLogPath, os.stat(accessLogPath))
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return False
+
+    # Returns an iterator over the cached transactions of a log file, or None if there are none or they are out of date
+    def load(self, accessLogPath, node):
+        cachePath = self.getCachePath(accessLogPath)
+        try:
+            with open(cachePath, 'rb') as cacheFileHandle:
+                version, key = marshal.load(cacheFileHandle)
+                if version != RecordCache.version or key != RecordCache.getKey(accessLogPath, os.stat(accessLogPath)):
+                    return None
+                columns = Columns.load(cacheFileHandle)
+
+            # Mark the cache file as recently used
+            os.utime(cachePath, None)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+        logger.info("Loading cached transactions of %s", accessLogPath)
+        return columns.getTransactions(node)
+
+    # Yields the transactions and caches them once all have been read
+    def cacheTransactions(self, accessLogPath, transactions):
+        key = RecordCache.getKey(accessLogPath, os.stat(accessLogPath))
+        columns = Columns()
+
+        for transaction in transactions:
+            columns.append(transaction)
+            yield transaction
+
+        self.store(accessLogPath, key, columns)
+
+    def store(self, accessLogPath, key, columns):
+        cachePath = self.getCachePath(accessLogPath)
+        temporaryPath = "%s.%d" % (cachePath, os.getpid())
+        try:
+            with open(temporaryPath, 'wb') as cacheFileHandle:
+                marshal.dump((RecordCache.version, key), cacheFileHandle)
+                columns.dump(cacheFileHandle)
+            os.rename(temporaryPath, cachePath)
+        except (IOError, OSError) as e:
+            logger.warn("Unable to cache the transactions of %s: %s", accessLogPath, e)
+            return
+
+        self.evict()
+
+    # Removes the least recently used cache files until the cache fits in its size limit
+    def evict(self):
+        cacheFiles = []
+        for f in os.listdir(self.cacheDir):
+            if f.endswith(RecordCache.extension):
+                try:
+                    stat = os.stat(os.path.join(self.cacheDir, f))
+                    cacheFiles.append((stat.st_mtime, stat.st_size, f))
+                except OSError:
+                    pass # Removed by another log reader
+
+        cacheFiles.sort()
+        cacheSize = sum([c[1] for c in cacheFiles])
+        while cacheFiles and cacheSize > self.sizeLimit:
+            mtime, size, f = cacheFiles.pop(0)
+            logger.info("Removing %s from the transaction cache", f)
+            try:
+                os.remove(os.path.join(self.cacheDir, f))
+            except OSError:
+                pass
+            cacheSize -= size
+
+# The transactions of one log file by field. Numeric fields are arrays and text fields are arrays of indexes into a
+# table of their distinct values. Dates are seconds since the epoch. Lines that could not be parsed are kept as they are.
+class Columns:
+    numericFields = ('date', 'size', 'time')
+    textFields = ('method', 'path', 'status', 'userAgent', 'contentType')
+    fields = numericFields + textFields
+    epoch = datetime.datetime.utcfromtimestamp(0)
+
+    def __init__(self):
+        self.numeric = dict((f, array.array('l')) for f in Columns.numericFields)
+        self.text = dict((f, array.array('I')) for f in Columns.textFields)
+        self.tables = dict((f, {}) for f in Columns.textFields)
+        self.unparsed = []
+
+    def append(self, transaction):
+        if not transaction.isValid():
+            self.unparsed.append(transaction.getRaw())
+            return
+
+        delta = transaction.date - Columns.epoch
+        self.numeric['date'].append(delta.days * 86400 + delta.seconds)
+        self.numeric['size'].append(transaction.size)
+        self.numeric['time'].append(transaction.time)
+
+        for f in Columns.textFields:
+            table = self.tables[f]
+            value = getattr(transaction, f)
+            index = table.get(value)
+            if index is None:
+                index = table[value] = len(table)
+            self.text[f].append(index)
+
+    def dump(self, fileHandle):
+        tables = {}
+        for f in Columns.textFields:
+            values = [None] * len(self.tables[f])
+            for value, index in self.tables[f].iteritems():
+                values[index] = value
+            tables[f] = values
+
+        marshal.dump(dict((f, c.tostring()) for f, c in self.numeric.items()), fileHandle)
+        marshal.dump(dict((f, c.tostring()) for f, c in self.text.items()), fileHandle)
+        marshal.dump(tables, fileHandle)
+        marshal.dump(self.unparsed, fileHandle)
+
+    @staticmethod
+    def load(fileHandle):
+        columns = Columns()
+        for f, data in marshal.load(fileHandle).items():
+            columns.numeric[f].fromstring(data)
+        for f, data in marshal.load(fileHandle).items():
+            columns.text[f].fromstring(data)
+        columns.tables = marshal.load(fileHandle)
+        columns.unparsed = marshal.load(fileHandle)
+        return columns
+
+    def getDates(self):
+        minutes = {}
+        for seconds in self.numeric['date']:
+            minute = minutes.get(seconds / 60)
+            if minute is None:
+                minute = minutes[seconds / 60] = Columns.epoch + datetime.timedelta(seconds=seconds - seconds % 60)
+            yield minute.replace(second=seconds % 60)
+
+    # Yields the transactions one at a time; a whole log file of them needn't fit in memory
+    def getTransactions(self, node):
+        values = [self.getDates(), self.numeric['size'], self.numeric['time']]
+        for f in Columns.textFields:
+            values.append(itertools.imap(self.tables[f].__getitem__, self.text[f]))
+
+        for record in itertools.izip(*values):
+            yield Transaction.fromRecord(Columns.fields, record, node)
+        for raw in self.unparsed:
+            yield Transaction(raw, node)
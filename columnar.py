@@ -0,0 +1,198 @@
+#!/usr/bin/python
+import datetime
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # The columnar engine isn't available
+
+from stats import StatsView, TimeIndex
+
+logger = logging.getLogger('columnar')
+
+# How a transaction counts in an Instant, in the order Instant.update tests them
+OTHER, AUTH_ERROR, SERVER_ERROR, USERVIEW, ASYNCVIEW = range(5)
+
+epoch = datetime.datetime.utcfromtimestamp(0)
+
+# Stats computed from columns of transactions rather than from an Instant per minute, hour and day. The log readers send
+# each transaction as a record of (minutes since the epoch, view class, time), which the aggregator appends to NumPy
+# arrays. The Instants of a resolution are then computed at once by grouping the columns by date: counts and sums with
+# bincount, and percentiles by sorting the times by date and time with lexsort and indexing each date's run of times.
+# Minutes are computed when the stats are built; hours, days and the stats of each node when they're first needed.
+class ColumnarStats(StatsView):
+
+    def __init__(self, minutes, viewClasses, times, nodeIds=None, nodes=None):
+        self.minuteColumn = minutes
+        self.viewClassColumn = viewClasses
+        self.timeColumn = times
+        self.nodeIdColumn = nodeIds
+        self.nodeIds = nodes or {}
+        StatsView.__init__(self, self.summarize(1))
+
+    @staticmethod
+    def isAvailable():
+        return numpy is not None
+
+    @staticmethod
+    def getRecord(transaction):
+        if transaction.isAuthError():
+            viewClass = AUTH_ERROR
+        elif transaction.isServerError():
+            viewClass = SERVER_ERROR
+        elif transaction.isUserview():
+            viewClass = USERVIEW
+        elif transaction.isAsyncview():
+            viewClass = ASYNCVIEW
+        else:
+            viewClass = OTHER
+
+        delta = transaction.date - epoch
+        return (delta.days * 1440 + delta.seconds / 60, viewClass, transaction.time)
+
+    # Builds the stats from batches of (node, records)
+    @staticmethod
+    def fromBatches(batchGenerator):
+        nodeIds = {}
+        columns = ([], [], [], [])
+        for node, records in batchGenerator:
+            if records:
+                batch = numpy.array(records, dtype=numpy.int64)
+                columns[0].append(batch[:, 0].astype(numpy.int32))
+                columns[1].append(batch[:, 1].astype(numpy.int8))
+                columns[2].append(batch[:, 2])
+                columns[3].append(numpy.repeat(numpy.int16(nodeIds.setdefault(node, len(nodeIds))), len(records)))
+
+        logger.info("Aggregating stats")
+        dtypes = (numpy.int32, numpy.int8, numpy.int64, numpy.int16)
+        minutes, viewClasses, times, nodeIdColumn = [numpy.concatenate(c) if c else numpy.zeros(0, dtype=t) for c, t in zip(columns, dtypes)]
+        return ColumnarStats(minutes, viewClasses, times, nodeIdColumn, nodeIds)
+
+    def getNode(self, node):
+        if not node in self.nodes:
+            selected = self.nodeIdColumn == self.nodeIds[node]
+            self.nodes[node] = ColumnarStats(self.minuteColumn[selected], self.viewClassColumn[selected], self.timeColumn[selected])
+        return self.nodes[node]
+
+    def getAllNodes(self):
+        for node in self.nodeIds:
+            self.getNode(node)
+        return self.nodes
+
+    def getHourIndex(self):
+        if self.hours is None:
+            self.hours = self.summarize(60)
+        return self.hours
+
+    def getDayIndex(self):
+        if self.days is None:
+            self.days = self.summarize(1440)
+        return self.days
+
+    # Returns a TimeIndex of the Summaries of the transactions grouped into periods of this many minutes
+    def summarize(self, resolution):
+        timeIndex = TimeIndex()
+        if not len(self.minuteColumn):
+            return timeIndex
+
+        dates, groups = numpy.unique(self.minuteColumn // resolution, return_inverse=True)
+        groupCount = len(dates)
+
+        def countOf(viewClass):
+            return numpy.bincount(groups[self.viewClassColumn == viewClass], minlength=groupCount)
+
+        transactionCounts = numpy.bincount(groups, minlength=groupCount)
+        authErrorCounts = countOf(AUTH_ERROR)
+        servErrorCounts = countOf(SERVER_ERROR)
+        userviews = ColumnarStats.summarizeTimes(groups, self.timeColumn, self.viewClassColumn == USERVIEW, groupCount)
+        asyncviews = ColumnarStats.summarizeTimes(groups, self.timeColumn, self.viewClassColumn == ASYNCVIEW, groupCount)
+
+        columns = [dates * resolution, transactionCounts, authErrorCounts, servErrorCounts] + userviews + asyncviews
+        for values in zip(*[c.tolist() for c in columns]):
+            timeIndex.add(Summary(epoch + datetime.timedelta(minutes=values[0]), *values[1:]))
+        return timeIndex
+
+    # Returns the count, total, 95th and 90th percentiles and standard deviation of the selected times of each group,
+    # computed the same way as Instant does
+    @staticmethod
+    def summarizeTimes(groups, times, selected, groupCount):
+        groups = groups[selected]
+        times = times[selected]
+
+        counts = numpy.bincount(groups, minlength=groupCount)
+        totals = numpy.bincount(groups, weights=times, minlength=groupCount).astype(numpy.int64)
+
+        # The times of each group in order, groups one after another
+        sortedTimes = times[numpy.lexsort((times, groups))]
+        starts = numpy.cumsum(counts) - counts
+        hasTimes = counts > 0
+
+        percentiles = []
+        for percentile in (.95, .9):
+            values = numpy.zeros(groupCount, dtype=numpy.int64)
+            values[hasTimes] = sortedTimes[starts[hasTimes] + (counts[hasTimes] * percentile).astype(numpy.int64)]
+            percentiles.append(values)
+
+        means = totals.astype(numpy.float64) / numpy.maximum(counts, 1)
+        squaredDeviations = numpy.bincount(groups, weights=(times - means[groups]) ** 2, minlength=groupCount)
+        stdDevs = numpy.sqrt(squaredDeviations / numpy.maximum(counts, 1))
+
+        return [counts, totals] + percentiles + [stdDevs]
+
+# The stats of one minute, hour or day, with the getters of Instant
+class Summary(object):
+    __slots__ = ('date', 'transactionCount', 'authErrorCount', 'servErrorCount', 'userviewCount', 'userviewTime', 'userview95Percentile', 'userview90Percentile', 'userviewStdDev', 'asyncviewCount', 'asyncviewTime', 'asyncview95Percentile', 'asyncview90Percentile', 'asyncviewStdDev')
+
+    def __init__(self, date, *values):
+        self.date = date
+        for field, value in zip(Summary.__slots__[1:], values):
+            setattr(self, field, value)
+
+    def getDate(self):
+        return self.date
+
+    def getTransactionCount(self):
+        return self.transactionCount
+
+    def getUserviewCount(self):
+        return self.userviewCount
+
+    def getAPITransactionCount(self):
+        return self.asyncviewCount
+
+    def getApiviewCount(self):
+        return self.asyncviewCount / 6
+
+    def getPageviewCount(self):
+        return self.userviewCount + self.getApiviewCount()
+
+    def getAuthErrorCount(self):
+        return self.authErrorCount
+
+    def getServErrorCount(self):
+        return self.servErrorCount
+
+    def getKilobytes(self):
+        return 0 # Instant doesn't count bytes either
+
+    def getUserviewAvgTime(self):
+        return float(self.userviewTime) / self.userviewCount if self.userviewCount else 0
+
+    def getAsyncviewAvgTime(self):
+        return float(self.asyncviewTime) / self.asyncviewCount if self.asyncviewCount else 0
+
+    def get95PercentileUserviewTime(self):
+        return self.userview95Percentile
+
+    def get95PercentileAsyncviewTime(self):
+        return self.asyncview95Percentile
+
+    def get90PercentileUserviewTime(self):
+        return self.userview90Percentile
+
+    def get90PercentileAsyncviewTime(self):
+        return self.asyncview90Percentile
+
+    def getStdDevUserviewTime(self):
+        return self.userviewStdDev
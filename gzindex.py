@@ -0,0 +1,321 @@
+#!/usr/bin/python
+import bisect
+import ctypes
+import ctypes.util
+import datetime
+import logging
+import marshal
+import md5
+import os
+import zlib
+
+from reader import DecompressingReader
+from transaction import getDate
+
+logger = logging.getLogger('gzindex')
+
+try:
+    libz = ctypes.CDLL(ctypes.util.find_library('z') or "libz.so.1")
+    libz.inflatePrime
+except (OSError, AttributeError):
+    libz = None # gzip compressed logs can only be read from the start
+
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+
+# zlib's z_stream
+class ZStream(ctypes.Structure):
+    _fields_ = [('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint), ('total_in', ctypes.c_ulong)
+        , ('next_out', ctypes.c_void_p), ('avail_out', ctypes.c_uint), ('total_out', ctypes.c_ulong)
+        , ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p)
+        , ('zalloc', ctypes.c_void_p), ('zfree', ctypes.c_void_p), ('opaque', ctypes.c_void_p)
+        , ('data_type', ctypes.c_int), ('adler', ctypes.c_ulong), ('reserved', ctypes.c_ulong)
+    ]
+
+if libz:
+    streamPointer = ctypes.POINTER(ZStream)
+    libz.zlibVersion.restype = ctypes.c_char_p
+    libz.inflateInit2_.argtypes = [streamPointer, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    libz.inflate.argtypes = [streamPointer, ctypes.c_int]
+    libz.inflateEnd.argtypes = [streamPointer]
+    libz.inflateReset2.argtypes = [streamPointer, ctypes.c_int]
+    libz.inflatePrime.argtypes = [streamPointer, ctypes.c_int, ctypes.c_int]
+    libz.inflateSetDictionary.argtypes = [streamPointer, ctypes.c_char_p, ctypes.c_uint]
+
+# A zlib inflate stream, for what the zlib module doesn't offer: stopping at the end of a deflate block, and starting in
+# the middle of a deflate stream with the bits and window that precede it
+class Inflater:
+    gzipWindowBits = 16 + zlib.MAX_WBITS
+    rawWindowBits = -zlib.MAX_WBITS
+    outputSize = 1024 * 1024
+
+    def __init__(self, windowBits):
+        self.stream = ZStream()
+        self.input = ""
+        self.output = ctypes.create_string_buffer(Inflater.outputSize)
+        self.check(libz.inflateInit2_(ctypes.byref(self.stream), windowBits, libz.zlibVersion(), ctypes.sizeof(ZStream)))
+
+    def __del__(self):
+        if libz:
+            libz.inflateEnd(ctypes.byref(self.stream))
+
+    def check(self, status):
+        if status < 0 and status != Z_BUF_ERROR:
+            raise zlib.error("Error %d while decompressing: %s" % (status, self.stream.msg))
+        return status
+
+    def feed(self, data):
+        self.input = data
+        self.stream.next_in = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+        self.stream.avail_in = len(data)
+
+    def getUnusedData(self):
+        return self.input[len(self.input) - self.stream.avail_in:]
+
+    # Returns the next block of decompressed data and zlib's status
+    def inflate(self, flush):
+        self.stream.next_out = ctypes.addressof(self.output)
+        self.stream.avail_out = Inflater.outputSize
+        status = self.check(libz.inflate(ctypes.byref(self.stream), flush))
+        return ctypes.string_at(self.output, Inflater.outputSize - self.stream.avail_out), status
+
+    # Whether more data can be decompressed without more input
+    def hasOutput(self):
+        return self.stream.avail_in > 0 or self.stream.avail_out == 0
+
+    # Whether the last inflate stopped at the end of a deflate block that isn't the last of its stream
+    def isAtBlockEnd(self):
+        return self.stream.data_type & 128 and not self.stream.data_type & 64
+
+    def getUnusedBits(self):
+        return self.stream.data_type & 7
+
+    def reset(self, windowBits):
+        self.check(libz.inflateReset2(ctypes.byref(self.stream), windowBits))
+
+    def prime(self, bits, value):
+        self.check(libz.inflatePrime(ctypes.byref(self.stream), bits, value))
+
+    def setDictionary(self, window):
+        self.check(libz.inflateSetDictionary(ctypes.byref(self.stream), window, len(window)))
+
+# Random access to a gzip compressed log file in the manner of zlib's zran example. The index holds a checkpoint every
+# spacing bytes of decompressed data, at the end of a deflate block: the decompressed offset, the compressed offset and
+# the bits of the compressed byte before it still to be decompressed, the 32 KB window of decompressed data that precedes
+# it, and the date of the first whole log entry after it. Decompression can start at any checkpoint, so the log can be
+# read from near a date or in independent parts by several log readers.
+#
+# An index is built while a log file is read from the start and saved in the working directory. It covers as much of the
+# file as was read; reading from its last checkpoint finds the rest. Like the transaction cache, an index is only used
+# while the path, size and modification time of its log file are unchanged.
+class GzipIndex:
+    version = 1
+    extension = ".gzi"
+    spacing = 8 * 1024 * 1024
+    blockSize = 256 * 1024 # Compressed bytes per read
+    windowSize = 32 * 1024
+    dateSearchSize = 64 * 1024 # Decompressed bytes after a checkpoint searched for a log entry with a date
+    epoch = datetime.datetime.utcfromtimestamp(0)
+
+    def __init__(self, path, checkpoints, size):
+        self.path = path
+        self.checkpoints = checkpoints # (decompressed offset, compressed offset, bits, window, date) tuples
+        self.size = size # The decompressed size if the whole file was read
+        self.offsets = [c[0] for c in checkpoints]
+
+    @staticmethod
+    def isAvailable():
+        return libz is not None
+
+    @staticmethod
+    def getIndexPath(indexDir, accessLogPath):
+        return os.path.join(indexDir, md5.new(os.path.abspath(accessLogPath)).hexdigest() + GzipIndex.extension)
+
+    @staticmethod
+    def getKey(accessLogPath, stat):
+        return [os.path.abspath(accessLogPath), stat.st_size, int(stat.st_mtime)]
+
+    # Returns the index of a gzip compressed log file, or None if there's none or it's out of date
+    @staticmethod
+    def load(indexDir, accessLogPath):
+        if not indexDir or not GzipIndex.isAvailable() or not accessLogPath.endswith('.gz'):
+            return None
+
+        try:
+            with open(GzipIndex.getIndexPath(indexDir, accessLogPath), 'rb') as indexFileHandle:
+                version, key = marshal.load(indexFileHandle)
+                if version != GzipIndex.version or key != GzipIndex.getKey(accessLogPath, os.stat(accessLogPath)):
+                    return None
+                size, checkpoints = marshal.load(indexFileHandle)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+        checkpoints = [(o, i, b, w, None if d is None else GzipIndex.epoch + datetime.timedelta(seconds=d)) for o, i, b, w, d in checkpoints]
+        return GzipIndex(accessLogPath, checkpoints, size)
+
+    # Whether a gzip compressed log file has an index covering all of it
+    @staticmethod
+    def isComplete(indexDir, accessLogPath):
+        gzipIndex = GzipIndex.load(indexDir, accessLogPath)
+        return gzipIndex is not None and gzipIndex.size is not None
+
+    def save(self, indexDir, key):
+        indexPath = GzipIndex.getIndexPath(indexDir, self.path)
+        temporaryPath = "%s.%d" % (indexPath, os.getpid())
+        checkpoints = [(o, i, b, w, None if d is None else int((d - GzipIndex.epoch).total_seconds())) for o, i, b, w, d in self.checkpoints]
+        try:
+            if not os.path.isdir(indexDir):
+                os.makedirs(indexDir)
+            with open(temporaryPath, 'wb') as indexFileHandle:
+                marshal.dump((GzipIndex.version, key), indexFileHandle)
+                marshal.dump((self.size, checkpoints), indexFileHandle)
+            os.rename(temporaryPath, indexPath)
+        except (IOError, OSError) as e:
+            logger.warn("Unable to save the index of %s: %s", self.path, e)
+
+    # Returns the decompressed offset of the last checkpoint at which the log entries are dated before date, or 0
+    def findStart(self, date):
+        start = 0
+        for offset, compressedOffset, bits, window, checkpointDate in self.checkpoints:
+            if checkpointDate is not None:
+                if checkpointDate > date:
+                    break
+                start = offset
+        return start
+
+    # Returns the decompressed offset of the first checkpoint at which the log entries are dated date or later, or None
+    def findStop(self, date):
+        for offset, compressedOffset, bits, window, checkpointDate in self.checkpoints:
+            if checkpointDate is not None and checkpointDate >= date:
+                return offset
+        return None
+
+    # Returns the checkpoint offsets within [start, stop) at least chunkSize decompressed bytes apart
+    def getSplitOffsets(self, start, stop, chunkSize):
+        offsets = []
+        for offset in self.offsets:
+            if offset > start and (stop is None or offset < stop) and offset - (offsets[-1] if offsets else start) >= chunkSize:
+                offsets.append(offset)
+        return offsets
+
+    # Yields the lines of the log file that start within [start, stop) of the decompressed data, decompressing from the
+    # last checkpoint before start. As for uncompressed log files, a line straddling start belongs to the previous range
+    # and one straddling stop to this one.
+    def readLines(self, start, stop):
+        i = bisect.bisect_right(self.offsets, start) - 1
+        checkpoint = self.checkpoints[i] if i >= 0 else None
+        offset = checkpoint[0] if checkpoint else 0
+        lines = iter(DecompressingReader(self.path, GzipIndex.inflate(self.path, checkpoint)))
+
+        # The rest of a line that started before the checkpoint
+        if checkpoint and not checkpoint[3].endswith("\n"):
+            offset += len(next(lines, ""))
+
+        for line in lines:
+            if stop is not None and offset >= stop:
+                break
+            if offset >= start:
+                yield line
+            offset += len(line)
+
+    # Yields the decompressed blocks of a gzip compressed log file from its start, and saves its index in indexDir as far
+    # as it was read
+    @staticmethod
+    def build(accessLogPath, indexDir):
+        key = GzipIndex.getKey(accessLogPath, os.stat(accessLogPath))
+        index = GzipIndex(accessLogPath, [], None)
+        try:
+            for block in GzipIndex.inflate(accessLogPath, None, index):
+                yield block
+        finally:
+            index.save(indexDir, key)
+
+    # Yields the decompressed blocks of a gzip file from the start or a checkpoint. Concatenated streams, as written by
+    # logrotate's compress and delaycompress, are decompressed one after another. The checkpoints are added to index, if
+    # given, as they are passed.
+    @staticmethod
+    def inflate(path, checkpoint, index=None):
+        with open(path, 'rb') as compressedFileHandle:
+            if checkpoint is None:
+                inflater = Inflater(Inflater.gzipWindowBits)
+                offset = 0
+                trailerSize = 0
+            else:
+                offset, compressedOffset, bits, window, date = checkpoint
+                inflater = Inflater(Inflater.rawWindowBits)
+                compressedFileHandle.seek(compressedOffset - (1 if bits else 0))
+                if bits:
+                    inflater.prime(bits, ord(compressedFileHandle.read(1)) >> (8 - bits))
+                inflater.setDictionary(window)
+                trailerSize = 8 # A raw deflate stream leaves the gzip trailer unread
+
+            window = ""
+            nextCheckpoint = offset + GzipIndex.spacing
+            pending = None # A checkpoint without a date yet and the decompressed data that follows it
+
+            data = compressedFileHandle.read(GzipIndex.blockSize)
+            while data:
+                inflater.feed(data)
+                while inflater.hasOutput():
+                    indexing = index is not None and offset >= nextCheckpoint
+                    block, status = inflater.inflate(Z_BLOCK if indexing else Z_NO_FLUSH)
+                    offset += len(block)
+
+                    if index is not None:
+                        window = block[-GzipIndex.windowSize:] if len(block) >= GzipIndex.windowSize else (window + block)[-GzipIndex.windowSize:]
+                        if pending and block:
+                            pending = GzipIndex.datePending(index, pending, block)
+
+                    if block:
+                        yield block
+
+                    if status == Z_STREAM_END:
+                        # The rest of the data belongs to the next stream, after this one's trailer
+                        data = inflater.getUnusedData()
+                        while len(data) < trailerSize:
+                            more = compressedFileHandle.read(GzipIndex.blockSize)
+                            if not more:
+                                break
+                            data += more
+                        data = data[trailerSize:] or compressedFileHandle.read(GzipIndex.blockSize)
+                        if not data:
+                            break
+                        inflater.reset(Inflater.gzipWindowBits)
+                        inflater.feed(data)
+                        trailerSize = 0
+                    elif indexing and inflater.isAtBlockEnd():
+                        compressedOffset = compressedFileHandle.tell() - inflater.stream.avail_in
+                        index.checkpoints.append((offset, compressedOffset, inflater.getUnusedBits(), window, None))
+                        index.offsets.append(offset)
+                        pending = GzipIndex.datePending(index, (len(index.checkpoints) - 1, ""), "")
+                        nextCheckpoint = offset + GzipIndex.spacing
+                    elif status == Z_BUF_ERROR:
+                        break
+
+                if status == Z_STREAM_END and not data:
+                    break
+                data = compressedFileHandle.read(GzipIndex.blockSize)
+
+            if index is not None:
+                index.size = offset
+
+    # Dates the pending checkpoint from the first whole log entry after it with a date. Returns the checkpoint and the
+    # data after it while it's still pending.
+    @staticmethod
+    def datePending(index, pending, block):
+        checkpointIndex, following = pending
+        following += block
+        offset, compressedOffset, bits, window, date = index.checkpoints[checkpointIndex]
+
+        lines = following.split("\n")
+        if not window.endswith("\n"):
+            lines.pop(0)
+        for line in lines[:-1]:
+            date = getDate(line)
+            if date is not None:
+                index.checkpoints[checkpointIndex] = (offset, compressedOffset, bits, window, date)
+                return None
+
+        return None if len(following) > GzipIndex.dateSearchSize else (checkpointIndex, following)
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+import logging
+import os
+import cPickle as pickle # Changed to "pickle" in Python 3
+
+from reader import isCompressed
+
+logger = logging.getLogger('incremental')
+
+# The part of a log file that has been aggregated, and its aggregated minutes
+class LogFileState:
+    def __init__(self, path, stat):
+        self.path = path
+        self.inode = stat.st_ino
+        self.size = stat.st_size
+        self.mtime = int(stat.st_mtime)
+        self.offset = 0
+        self.minutes = {}
+
+    def isUnchanged(self, stat):
+        return self.inode == stat.st_ino and self.size == stat.st_size and self.mtime == int(stat.st_mtime)
+
+    def update(self, minutes):
+        for minute in minutes:
+            if minute.getDate() in self.minutes:
+                self.minutes[minute.getDate()].merge(minute)
+            else:
+                self.minutes[minute.getDate()] = minute
+
+# Keeps the minutes aggregated from each access log in the working directory, along with how much of each log has been
+# read, so that a later run only reads what has been appended since. Compressed logs never change once rotated; they are
+# read again only if they do. Uncompressed logs are followed by inode, so the live log is still recognized after it has
+# been renamed by a rotation, and read again from the start if it was replaced or truncated. Logs that are no longer
+# selected are forgotten.
+#
+# The aggregates depend on the filters applied by the log readers and on the sketch accuracy; they are discarded when
+# either changes.
+class IncrementalState:
+    version = 2
+    fileName = "incremental.dat"
+
+    def __init__(self, workDir, filterDigest):
+        self.statePath = os.path.join(workDir, IncrementalState.fileName)
+        self.filterDigest = filterDigest
+        self.logFiles = {}
+
+        if os.path.isfile(self.statePath):
+            try:
+                with open(self.statePath, "rb") as stateFileHandle:
+                    version, digest, logFiles = pickle.load(stateFileHandle)
+                if version != IncrementalState.version:
+                    logger.info("%s was written by another version; all access logs will be read", self.statePath)
+                elif digest == filterDigest:
+                    self.logFiles = logFiles
+                else:
+                    logger.info("The filters or sketch accuracy have changed since the last incremental run; all access logs will be read")
+            except (IOError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError) as e:
+                logger.warn("Unable to read %s; all access logs will be read: %s", self.statePath, e)
+
+    # Returns the byte ranges, (path, start, stop), of the access logs that haven't been aggregated
+    def getLogFileRanges(self, accessLogPaths):
+        previousLogFiles = self.logFiles
+        renamedLogFiles = dict((s.inode, s) for s in previousLogFiles.values() if not isCompressed(s.path))
+        self.logFiles = {}
+
+        logFileRanges = []
+        for accessLogPath in accessLogPaths:
+            stat = os.stat(accessLogPath)
+            state = previousLogFiles.get(accessLogPath)
+
+            if isCompressed(accessLogPath):
+                if state and state.isUnchanged(stat):
+                    self.logFiles[accessLogPath] = state
+                    continue
+
+                state = LogFileState(accessLogPath, stat)
+                logFileRanges.append((accessLogPath, 0, None))
+            else:
+                if not state or state.inode != stat.st_ino:
+                    state = renamedLogFiles.get(stat.st_ino)
+
+                if not state or state.inode != stat.st_ino or stat.st_size < state.offset:
+                    state = LogFileState(accessLogPath, stat)
+                elif state.path != accessLogPath:
+                    logger.info("%s was renamed to %s", state.path, accessLogPath)
+
+                # Only read whole lines; the last one may still be being written
+                stop = IncrementalState.getLastLineEnd(accessLogPath, stat.st_size)
+                if stop > state.offset:
+                    logFileRanges.append((accessLogPath, state.offset, stop))
+
+                state.path = accessLogPath
+                state.size = stat.st_size
+                state.mtime = int(stat.st_mtime)
+                state.offset = max(stop, state.offset)
+
+            self.logFiles[accessLogPath] = state
+
+        keptStates = set([id(s) for s in self.logFiles.values()])
+        for path, state in previousLogFiles.items():
+            if not id(state) in keptStates:
+                logger.info("Forgetting the stats aggregated from %s", path)
+
+        return logFileRanges
+
+    def update(self, accessLogPath, minutes):
+        self.logFiles[accessLogPath].update(minutes)
+
+    # Yields the aggregated minutes of every log file in the form the log readers send them, (node, (path, minutes))
+    def getBatches(self):
+        for path, state in self.logFiles.items():
+            yield os.path.dirname(path), (path, state.minutes.values())
+
+    def save(self):
+        temporaryPath = self.statePath + ".tmp"
+        with open(temporaryPath, "wb") as stateFileHandle:
+            pickle.dump((IncrementalState.version, self.filterDigest, self.logFiles), stateFileHandle, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporaryPath, self.statePath)
+
+    # Returns the offset following the last newline before size
+    @staticmethod
+    def getLastLineEnd(path, size):
+        blockSize = 64 * 1024
+        with open(path, "rb") as logFileHandle:
+            end = size
+            while end > 0:
+                start = max(end - blockSize, 0)
+                logFileHandle.seek(start)
+                newline = logFileHandle.read(end - start).rfind("\n")
+                if newline >= 0:
+                    return start + newline + 1
+                end = start
+        return 0
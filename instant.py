@@ -2,8 +2,13 @@
 import math
 
 from transaction import Transaction
+from sketch import LatencySketch
 
-class Instant:
+class Instant(object):
+    __slots__ = ('date', 'transactionCount', 'userviewCount', 'asyncviewCount', 'authErrorCount', 'servErrorCount', 'bytes', 'userviewTime', 'userviewTimes', 'asyncviewTime', 'asyncviewTimes')
+
+    # When set, transaction times are summarized by sketches of this relative accuracy instead of being kept in lists
+    sketchAccuracy = None
 
     def __init__(self, date):
         self.date = date
@@ -14,9 +19,22 @@ class Instant:
         self.servErrorCount = 0
         self.bytes = 0
         self.userviewTime = 0
-        self.userviewTimes = []
+        self.userviewTimes = Instant.newTimes()
         self.asyncviewTime = 0
-        self.asyncviewTimes = []
+        self.asyncviewTimes = Instant.newTimes()
+
+    @staticmethod
+    def newTimes():
+        return LatencySketch(Instant.sketchAccuracy) if Instant.sketchAccuracy else []
+
+    @staticmethod
+    def getPercentile(times, percentile):
+        if not times:
+            return 0
+        elif isinstance(times, LatencySketch):
+            return times.getPercentile(percentile)
+        times.sort()
+        return times[int(len(times) * percentile)]
 
     def getDate(self):
         return self.date
@@ -79,34 +97,21 @@ class Instant:
         return float(self.asyncviewTime) / self.asyncviewCount if self.asyncviewCount else 0
 
     def get95PercentileUserviewTime(self):
-        if not self.userviewTimes:
-            return 0
-        self.userviewTimes.sort()
-        return self.userviewTimes[int(len(self.userviewTimes) * .95)]
+        return Instant.getPercentile(self.userviewTimes, .95)
 
     def get95PercentileAsyncviewTime(self):
-        if not self.asyncviewTimes:
-            return 0
-        self.asyncviewTimes.sort()
-        return self.asyncviewTimes[int(len(self.asyncviewTimes) * .95)]
+        return Instant.getPercentile(self.asyncviewTimes, .95)
 
     def get90PercentileUserviewTime(self):
-        self.userviewTimes.sort()
-        return self.userviewTimes[int(len(self.userviewTimes) * .9)]
+        return Instant.getPercentile(self.userviewTimes, .9)
 
     def get90PercentileAsyncviewTime(self):
-        self.asyncviewTimes.sort()
-        return self.asyncviewTimes[int(len(self.asyncviewTimes) * .9)]
-
-    def getStdDevUserviewTime(self):
-        if self.userviewCount > 0:
-            mean = self.getUserviewAvgTime()
-            return math.sqrt(reduce(lambda x, y: x + y, [(x - mean)**2 for x in self.userviewTimes]) / self.userviewCount)
-        else:
-            return 0
+        return Instant.getPercentile(self.asyncviewTimes, .9)
 
     def getStdDevUserviewTime(self):
-        if self.userviewCount > 0:
+        if isinstance(self.userviewTimes, LatencySketch):
+            return self.userviewTimes.getStdDev()
+        elif self.userviewCount > 0:
             mean = self.getUserviewAvgTime()
             return math.sqrt(reduce(lambda x, y: x + y, [(x - mean)**2 for x in self.userviewTimes]) / self.userviewCount)
         else:
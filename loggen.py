@@ -0,0 +1,175 @@
+#!/usr/bin/python
+#
+# Writes synthetic access logs for benchmarks
+#
+# Usage
+#   loggen.py [options] {output dir}
+#
+# The logs resemble those of a Jive cluster: a directory of logs for each webapp node, holding a live uncompressed log
+# for the last day and a gzip compressed log rotated for each day before it. Requests are for the pages, REST services
+# and API endpoints of Tree.pathPatterns with a few popular resources and a long tail, returning HTML, JSON, scripts and
+# images. Entries are written in the order requests complete, so, as in real logs, they are only roughly in date order.
+# The same options always write the same logs.
+
+import datetime
+import gzip
+import os
+import random
+
+from optparse import OptionParser
+
+import transaction
+
+from profile import Tree
+
+# Resource kinds: (weight, method weights, content type, status weights)
+pageKind = (30, [("GET", 95), ("POST", 5)], "text/html", [("200", 90), ("302", 6), ("404", 2), ("403", 1), ("500", 1)])
+serviceKind = (35, [("GET", 80), ("POST", 12), ("PUT", 6), ("DELETE", 2)], "application/json", [("200", 94), ("401", 2), ("404", 2), ("500", 1), ("503", 1)])
+apiKind = (20, [("GET", 90), ("POST", 8), ("PUT", 2)], "application/json", [("200", 95), ("401", 2), ("404", 2), ("500", 1)])
+staticKind = (10, [("GET", 100)], "text/javascript", [("200", 70), ("304", 30)])
+imageKind = (5, [("GET", 100)], "image/png", [("200", 80), ("304", 20)])
+
+# Relative traffic of each hour of the day, busiest during office hours
+hourWeights = [2, 1, 1, 1, 1, 2, 4, 7, 10, 12, 12, 11, 10, 11, 12, 12, 10, 8, 6, 5, 4, 4, 3, 2]
+
+userAgents = [("Mozilla/5.0 (Windows NT 6.1; WOW64; Trident/7.0; rv:11.0) like Gecko", 30)
+    , ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/600.1.25 (KHTML, like Gecko) Version/8.0 Safari/600.1.25", 25)
+    , ("Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/38.0.2125.111 Safari/537.36", 30)
+    , ("JiveClient", 8)
+    , ("WebInject", 7)
+]
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] {output dir}")
+    parser.add_option("-n", "--nodes", dest="nodes", type="int", default=4, help="Number of webapp nodes")
+    parser.add_option("-d", "--days", dest="days", type="int", default=3, help="Days of logs for each node; all but the last are rotated and compressed")
+    parser.add_option("-l", "--lines", dest="lines", type="int", default=100000, help="Log entries per node per day")
+    parser.add_option("-s", "--start", dest="startDate", default="01/Nov/2014", help="First day of the logs, e.g. 01/Nov/2014")
+    parser.add_option("-H", "--hosted", dest="hosted", action="store_true", default=False, help="Write transaction.hostedLogFormat instead of the on-premise format")
+    parser.add_option("-r", "--seed", dest="seed", type="int", default=1, help="Seed of the random choices")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("An output directory is required")
+
+    startDate = datetime.datetime.strptime(options.startDate, "%d/%b/%Y")
+    for node in range(options.nodes):
+        for path in writeNodeLogs(args[0], node, startDate, options.days, options.lines, options.hosted, options.seed):
+            print path
+
+# Writes the logs of one node and returns their paths
+def writeNodeLogs(outputDir, node, startDate, days, lines, hosted, seed):
+    nodeDir = os.path.join(outputDir, "node%d" % node)
+    if not os.path.isdir(nodeDir):
+        os.makedirs(nodeDir)
+
+    generator = LogEntryGenerator(random.Random(seed * 1000 + node), node, hosted)
+    paths = []
+    for day in range(days):
+        date = startDate + datetime.timedelta(days=day)
+        if day == days - 1:
+            path = os.path.join(nodeDir, "jive-httpd-access.log")
+            logFileHandle = open(path, 'w')
+        else:
+            # The date in the name of a rotated log is the day after its entries
+            path = os.path.join(nodeDir, (date + datetime.timedelta(days=1)).strftime("jive-httpd-access.log-%Y%m%d.gz"))
+            logFileHandle = gzip.open(path, 'wb')
+
+        with logFileHandle:
+            for entry in generator.getDay(date, lines):
+                logFileHandle.write(entry + "\n")
+        paths.append(path)
+    return paths
+
+def weightedChoice(rng, choices):
+    point = rng.uniform(0, sum([w for c, w in choices]))
+    for choice, weight in choices:
+        point -= weight
+        if point <= 0:
+            return choice
+    return choices[-1][0]
+
+class LogEntryGenerator:
+    def __init__(self, rng, node, hosted):
+        self.rng = rng
+        self.node = node
+        self.hosted = hosted
+        self.kinds = [(kind, [p for p in Tree.pathPatterns if LogEntryGenerator.getKind(p) is kind]) for kind in (pageKind, serviceKind, apiKind, staticKind, imageKind)]
+
+    @staticmethod
+    def getKind(pattern):
+        if pattern.startswith("/__services/"):
+            return serviceKind
+        elif pattern.startswith("/api/"):
+            return apiKind
+        elif "/resources/" in pattern or "/themes/" in pattern or "/plugins/" in pattern:
+            return staticKind
+        elif "Image" in pattern or "avatar" in pattern or pattern.startswith("/photos"):
+            return imageKind
+        else:
+            return pageKind
+
+    # A few popular resources and a long tail
+    def getId(self):
+        return 1000 + int(self.rng.paretovariate(0.6)) % 100000
+
+    def getPath(self, pattern):
+        segments = []
+        for segment in pattern.split("/"):
+            if segment == "**":
+                segments.extend(["%d" % self.getId() for i in range(self.rng.randint(1, 3))])
+            elif "*" in segment:
+                segments.append(segment.replace("**", "%d" % self.getId()).replace("*", "%d" % self.getId()))
+            else:
+                segments.append(segment)
+        path = "/".join(segments)
+        if self.rng.random() < 0.2:
+            path += "?_=%d" % self.rng.randint(10 ** 12, 10 ** 13)
+        return path
+
+    # Returns the log entries of one day in the order their requests complete
+    def getDay(self, date, count):
+        requests = []
+        for i in range(count):
+            hour = weightedChoice(self.rng, list(enumerate(hourWeights)))
+            received = date + datetime.timedelta(hours=hour, seconds=self.rng.random() * 3600)
+            time = int(self.rng.lognormvariate(9.5, 1.2)) # Microseconds
+            if self.rng.random() < 0.001:
+                time *= 200 # A few requests take minutes
+            requests.append((received + datetime.timedelta(microseconds=time), received, time))
+        requests.sort()
+
+        for completed, received, time in requests:
+            yield self.getEntry(received, time)
+
+    def getEntry(self, received, time):
+        rng = self.rng
+        kind, patterns = weightedChoice(rng, [(k, k[0][0]) for k in self.kinds if k[1]])
+        weight, methods, contentType, statuses = kind
+        status = weightedChoice(rng, statuses)
+        method = weightedChoice(rng, methods)
+        if method == "POST" and kind is pageKind:
+            status = "302"
+
+        clientAddress = "10.%d.%d.%d" % (self.node, rng.randint(0, 255), rng.randint(1, 254))
+        if self.hosted:
+            prefix = "%s - %s" % (clientAddress, "%d" % rng.randint(2000, 90000) if rng.random() < 0.7 else "-")
+        else:
+            prefix = "%s - -" % clientAddress
+
+        return '%s [%s +0000] "%s %s HTTP/1.1" %s %s %d 0 "%s" "%s" "%s" %032X %d' % (prefix
+            , received.strftime(transaction.dateFormat)
+            , method
+            , self.getPath(rng.choice(patterns))
+            , status
+            , "-" if status == "304" else "%d" % int(rng.lognormvariate(8, 1.5))
+            , time
+            , "https://community.example.com%s" % self.getPath(rng.choice(self.kinds[0][1]))
+            , weightedChoice(rng, userAgents)
+            , contentType if status in ("200", "304") else "text/html"
+            , rng.getrandbits(128)
+            , rng.randint(1, 20000))
+
+if __name__ == "__main__":
+    main()
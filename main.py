@@ -15,38 +15,49 @@
 #   optparse is deprecated; use argparse instead (new in version 3.2)
 
 import datetime
+import itertools
 import json
 import locale
 import math
 import md5
 import os
 import re
+import socket
 import subprocess
 import logging
+import mmap
 import multiprocessing
+import operator
 import textwrap
+import traceback
 import Queue # Changed to "queue" in Python 3
+import cPickle as pickle # Changed to "pickle" in Python 3
 
 from optparse import OptionParser
 
 from stats import Stats
-from transaction import Transaction
+from instant import Instant
+from transaction import Transaction, LogParser, fullParser, getDate, getDateOutsideRange, parseDate
 from profile import Tree
+from reader import isCompressed, openCompressed
+from cache import RecordCache
+from incremental import IncrementalState
+from columnar import ColumnarStats
+from gzindex import GzipIndex
+from timing import StageTimes, PipelineProfile
+from ring import RecordRing, RingBatch
+from partial import PartialStats
 
 dateFormat="%d/%b/%Y:%H:%M:%S" # Consider the timezone to be local
 locale.setlocale(locale.LC_ALL, 'en_US')
 
 logger = logging.getLogger('main')
 
-# Global multiprocessing objects
-# This is a simplier alternative then using a manager to start a server and provide proxies to server objects...
-transactionQueue = multiprocessing.Queue()
-accessLogPathQueue = multiprocessing.Queue()
-logFilesProcessed = multiprocessing.Value('b', False)
+logReaderCheckInterval = 2 # Seconds between checks that the log readers are still running while none sends a batch
 
 def main():
     # Define the CLI
-    parser = OptionParser(usage="usage: %prog [options] -w {working directory} [log directory]...")
+    parser = OptionParser(usage="usage: %prog [options] -w {working directory} [log directory]...\n       %prog [options] -w {working directory} --merge {partial stats file}...")
     parser.add_option("-s", "--start", dest="startDate", help="String representing the start date in the format used by the log file, e.g.: 12/May/2014:09:00")
     parser.add_option("-t", "--stop", dest="stopDate", help="String representing the stop date in the format used by the log file, e.g.: 12/May/2014:18:00")
     parser.add_option("-w", "--working_dir", dest="workDir", help="Path to directory to usPath to directory for files created by this script")
@@ -65,6 +76,19 @@ def main():
     parser.add_option("-c", "--context", dest="context", default="", help="Site context")
     parser.add_option("-a", "--apitime", action="store_true", dest="apitime", default=False, help="Plot APIview time instead of Userview time")
     parser.add_option("-A", "--agent", dest="agent", help="Filter out transactions without a matching user agent")
+    parser.add_option("-I", "--incremental", dest="incremental", action="store_true", default=False, help="Only process the access log entries added since the last incremental run")
+    parser.add_option("-g", "--reader_agg", dest="readerAgg", action="store_true", default=False, help="Aggregate pageview stats in the log readers and merge them afterwards")
+    parser.add_option("-k", "--chunk_size", dest="chunkSize", type="int", default=64, help="Split uncompressed access logs, and indexed gzip compressed ones once decompressed, larger than this many MB between log readers")
+    parser.add_option("-C", "--cache_size", dest="cacheSize", type="int", default=1024, help="MB of parsed compressed access logs to keep in the working directory; 0 disables the cache. A compressed log is parsed in full, whatever the date range, the first time it's read.")
+    parser.add_option("-b", "--batch", dest="batchSize", type="int", default=5000, help="Number of log entries a log reader sends to the aggregator at once")
+    parser.add_option("-Q", "--queue_size", dest="queueSize", type="int", default=32, help="Number of batches that may wait for the aggregator. Log readers wait while the queue is full, so this bounds the memory the waiting batches take.")
+    parser.add_option("-N", "--numpy", dest="numpy", action="store_true", default=False, help="Aggregate pageview stats in NumPy arrays instead of per-minute objects")
+    parser.add_option("-T", "--tolerance", dest="tolerance", type="int", default=10, help="Minutes by which log entries may be out of date order. Reading starts this long before the start date and stops this long after the stop date.")
+    parser.add_option("-P", "--profile", dest="profile", action="store_true", default=False, help="Report the time spent in each stage of reading, aggregating and plotting, and write it to profile.json in the working directory. Timing every log entry slows the log readers a little. Implies -f")
+    parser.add_option("-R", "--ring", dest="ring", action="store_true", default=False, help="Send the records of the log entries through ring buffers in shared memory instead of pickling them through the transaction queue")
+    parser.add_option("-S", "--sketch", dest="sketchAccuracy", type="float", help="Estimate percentile transaction times to this relative accuracy, e.g. 0.01, instead of keeping every transaction time in memory")
+    parser.add_option("-E", "--emit-partial", dest="emitPartial", help="Write the stats aggregated by the minute for each node to this file instead of plotting them, to be merged with those of other hosts by --merge. Implies -g")
+    parser.add_option("-G", "--merge", dest="merge", action="store_true", default=False, help="Plot the stats merged from the files written by --emit-partial given in place of log directories")
 
     (options, args) = parser.parse_args()
 
@@ -75,8 +99,9 @@ def main():
     pageviewsByDayDataFilePath = "%s/pageviews_by_day" % options.workDir 
     infoFilePath = "%s/info.json" % options.workDir
     pathRE = None if not options.match else re.compile(options.match)
+    tolerance = datetime.timedelta(minutes=options.tolerance)
 
-    if options.tree or options.days:
+    if options.tree or options.days or options.profile or options.emitPartial:
         options.force = True
 
     if options.quiet:
@@ -87,8 +112,9 @@ def main():
         setLoggingLevel(logging.INFO)
 
     context = options.context.strip("/")
+    Instant.sketchAccuracy = options.sketchAccuracy
 
-    errorMsgs = validateOptions(options.workDir, startDate, stopDate, parser.get_usage())
+    errorMsgs = validateOptions(options, startDate, stopDate, parser.get_usage())
     if errorMsgs:
         print "Unable to proceed. Adjustment your command or environment by the following and try again."
         for i in range(len(errorMsgs)):
@@ -96,10 +122,16 @@ def main():
         print
         exit(1)
 
-    accessLogPaths = getAccessLogs(args, startDate, stopDate, options.filterLogs)
+    if options.merge:
+        partialStats = loadPartialStats(args, options.sketchAccuracy)
+        options.sketchAccuracy = Instant.sketchAccuracy = partialStats[0][1].sketchAccuracy
 
-    if shouldRecalculate(options, infoFilePath, dataFilePath, accessLogPaths):
+    # The partial stats files take the place of the access logs when merging
+    accessLogPaths = args if options.merge else getAccessLogs(args, startDate, stopDate, options.filterLogs)
+
+    if options.incremental or shouldRecalculate(options, infoFilePath, dataFilePath, accessLogPaths):
         logger.info("Plot data is stale or missing. Recaculating...")
+        profile = PipelineProfile() if options.profile else None
 
         if not accessLogPaths:
             logger.error("No access logs found. Be sure their names match the pattern, ^jive-httpd(?:-ssl)?-access\.log.*")
@@ -108,17 +140,44 @@ def main():
         for p in accessLogPaths:
             logger.info("Will process %s", p)
 
-        transactionGenerator = processLogFiles(accessLogPaths, startDate, stopDate, pathRE, options.agent)
+        # The request tree needs every transaction, so it cannot be built from partial aggregates
+        readerAgg = options.readerAgg and not options.tree or options.incremental or bool(options.emitPartial)
+        recordFields = getRecordFields(options.tree)
+        getRecord = ColumnarStats.getRecord if options.numpy else operator.attrgetter(*recordFields)
+        logParser = getLogParser(recordFields, pathRE, options.agent)
+        recordCache = getRecordCache(options.workDir, options.cacheSize)
+        indexDir = os.path.join(options.workDir, "index")
+        ringFields = recordFields if options.ring and RecordRing.isSupported(recordFields) else None
+        if options.ring and not ringFields:
+            logger.warn("The raw log entries reported when debugging can't be sent through ring buffers; sending the records through the transaction queue")
+
+        if options.incremental:
+            incrementalState = IncrementalState(options.workDir, getFilterDigest(options))
+            logFileRanges = incrementalState.getLogFileRanges(accessLogPaths)
+        else:
+            logFileRanges = [(p, 0, None) for p in accessLogPaths]
+
+        if options.merge:
+            batches = itertools.chain(*[p.getBatches(path) for path, p in partialStats])
+        elif logFileRanges:
+            batches = processLogFiles(logFileRanges, startDate, stopDate, pathRE, options.agent, getRecord, options.batchSize, readerAgg, options.chunkSize * 1024 * 1024, tolerance, logParser, recordCache, indexDir, options.queueSize, ringFields, profile)
+        else:
+            logger.info("No new httpd access log entries to read")
+            batches = []
 
         if options.tree:
             # Traffic Profiling
-            transactionTree = Tree(transactionGenerator, context, startDate, stopDate)
+            if profile:
+                profile.switch('tree')
+            transactionTree = Tree(transactionGenerator(batches, recordFields), context, startDate, stopDate)
 
             if transactionTree.getTotalExecutionTime() < 1:
                 logger.error("Not enough transactions met the critieria. Try adjusting the time frame.")
                 exit(3)
 
             transactionTree.printSummary()
+            if profile:
+                profile.switch('plot')
             mostTimeConsuming = transactionTree.writeMostTimeConsumingPlot(options.workDir)
             mostFrequent = transactionTree.writeHighestThroughputPlot(options.workDir)
 
@@ -129,14 +188,33 @@ def main():
             print mostFrequent
 
         else:
-            stats = getStats(transactionGenerator)
+            if profile:
+                profile.switch('aggregate')
+            if options.incremental:
+                for node, (accessLogPath, minutes) in batches:
+                    incrementalState.update(accessLogPath, minutes)
+                incrementalState.save()
+                stats = mergeStats(incrementalState.getBatches())
+            elif readerAgg or options.merge:
+                stats = mergeStats(batches)
+            elif options.numpy:
+                stats = ColumnarStats.fromBatches(batches)
+            else:
+                stats = getStats(transactionGenerator(batches, recordFields))
+
             if stats.isEmpty():
                 logger.error("No transactions were processed")
                 exit(4)
 
             printStats(stats)
+            if profile:
+                profile.switch('plot')
+
+            if options.emitPartial:
+                PartialStats.fromStats(socket.gethostname(), getFilterDigest(options), options.sketchAccuracy, stats).write(options.emitPartial)
+                print "Wrote the stats of {0:d} nodes to {1:s}. Plot them with those of other hosts with --merge.".format(len(stats.getAllNodes()), options.emitPartial)
 
-            if options.days:
+            elif options.days:
                 gnuFile = writePageviewsByDayPlotData(stats, startDate, stopDate, pageviewsByDayDataFilePath, options.environment)
 
                 print "View pageviews by day by executing the following command."
@@ -157,7 +235,12 @@ def main():
                 writePageviewPlotData(hours, minutes, startDate, stopDate, dataFilePath, options.hourly)
                 writePlotInfo(options, minutes, startDate, stopDate, infoFilePath)
 
-    if not options.tree and not options.days:
+        if profile:
+            profile.finish()
+            profile.write(options.workDir)
+            profile.printReport()
+
+    if not options.tree and not options.days and not options.emitPartial:
         with open (infoFilePath, "r") as infoFileHandle:
             plotInfo = json.load(infoFileHandle)
             printPlotInfo(plotInfo)
@@ -168,7 +251,7 @@ def main():
 # Filter out old log files
 def filterAccessLogs(accessLogPaths, startDate, stopDate):
     logFileNameDateFormat="%Y%m%d"
-    logFileFormat = re.compile('.*/jive-httpd(?:-ssl)?-access\.log-(?P<date>\d{8})(?:.gz)?$')
+    logFileFormat = re.compile('.*/jive-httpd(?:-ssl)?-access\.log-(?P<date>\d{8})(?:\.gz|\.bz2|\.xz)?$')
     numberOfWeeks = 2
 
     datePaths = []
@@ -207,17 +290,131 @@ def isDataStale(infoFilePath, dataFilePath, logFileTime):
     return False
 
 def getOptionDigest(options):
-    return md5.new( "%s - %s, %s" % ("X" if not options.startDate else options.startDate, "X" if not options.stopDate else options.stopDate, "by hour" if options.hourly else "by minute")).hexdigest()
+    sketch = "" if not options.sketchAccuracy else ", sketch %g" % options.sketchAccuracy
+    return md5.new( "%s - %s, %s%s" % ("X" if not options.startDate else options.startDate, "X" if not options.stopDate else options.stopDate, "by hour" if options.hourly else "by minute", sketch)).hexdigest()
+
+# The filters applied by the log readers and the form of the transaction times, which incrementally aggregated stats
+# depend on
+def getFilterDigest(options):
+    return md5.new("%s - %s, %s, %s, %s" % (options.startDate, options.stopDate, options.match, options.agent, options.sketchAccuracy)).hexdigest()
 
 def optionsMatch(options, info):
     return info.has_key('optionDgst') and info['optionDgst'] == getOptionDigest(options)
 
-def logFile(path):
-    if path.endswith('.gz'):
-        return subprocess.Popen(["gunzip", "--stdout", path], shell=False, bufsize=-1, stdout=subprocess.PIPE).stdout
+# Gzip compressed log files are indexed as they're read from the start when indexDir is given, and read from their index
+# when only part of them is
+def logFile(path, start=0, stop=None, indexDir=None):
+    if isCompressed(path) and (start or stop is not None):
+        return (GzipIndex.load(indexDir, path) or GzipIndex(path, [], None)).readLines(start, stop)
+    elif isCompressed(path):
+        if indexDir and GzipIndex.isAvailable() and path.endswith('.gz') and not GzipIndex.isComplete(indexDir, path):
+            return openCompressed(path, GzipIndex.build(path, indexDir))
+        return openCompressed(path)
+    elif start or stop is not None:
+        return logFileRange(path, start, stop)
     else:
         return open(path, 'r')
 
+# Yields the lines of an uncompressed log file that start within [start, stop). A line straddling start belongs to the
+# previous range and one straddling stop to this one, so consecutive ranges yield every line exactly once.
+def logFileRange(path, start, stop):
+    with open(path, 'r') as logFileHandle:
+        if start > 0:
+            logFileHandle.seek(start - 1)
+            start += len(logFileHandle.readline()) - 1
+
+        for line in logFileHandle:
+            if stop is not None and start >= stop:
+                break
+            start += len(line)
+            yield line
+
+# Narrows the byte ranges, (path, start, stop), of uncompressed log files to the lines dated from the tolerance before
+# the start date to the tolerance after the stop date. httpd dates a log entry when the request is received but writes it
+# when the response is sent, so entries are only in date order to within the duration of the longest requests. Ranges
+# left empty are dropped. Compressed files can only be narrowed to the checkpoints of their gzip index, if they have one;
+# their ranges are of the decompressed data.
+def seekLogFileRanges(logFileRanges, startDate, stopDate, tolerance, gzipIndexes):
+    seekedRanges = []
+    for accessLogPath, start, stop in logFileRanges:
+        gzipIndex = gzipIndexes.get(accessLogPath)
+        if gzipIndex and not start and stop is None:
+            start = gzipIndex.findStart(startDate - tolerance) if startDate else 0
+            stop = gzipIndex.findStop(stopDate + tolerance) if stopDate else None
+
+            if stop is not None and start >= stop:
+                logger.info("Skipping %s; none of its log entries are in the date range", accessLogPath)
+                continue
+            logger.debug("Reading %s from decompressed byte %d to %s", accessLogPath, start, "end" if stop is None else stop)
+        elif not isCompressed(accessLogPath) and (startDate or stopDate):
+            end = os.path.getsize(accessLogPath) if stop is None else stop
+            if startDate:
+                start = findDateOffset(accessLogPath, start, end, startDate - tolerance)
+            if stopDate:
+                stopOffset = findDateOffset(accessLogPath, start, end, stopDate + tolerance)
+                if stopOffset < end:
+                    stop = stopOffset
+
+            if start >= end or stop is not None and start >= stop:
+                logger.info("Skipping %s; none of its log entries are in the date range", accessLogPath)
+                continue
+            logger.debug("Reading %s from byte %d to %s", accessLogPath, start, "end" if stop is None else stop)
+
+        seekedRanges.append((accessLogPath, start, stop))
+    return seekedRanges
+
+# Returns the offset of the first line within [start, end) dated date or later, or end if there's none, by binary search.
+# start must be the start of a line. Lines whose date can't be told are passed over.
+def findDateOffset(path, start, end, date):
+    with open(path, 'rb') as logFileHandle:
+        while start < end:
+            middle = (start + end) / 2
+
+            # Find the first dated line starting at or after the middle
+            if middle > start:
+                logFileHandle.seek(middle - 1)
+                lineStart = middle + len(logFileHandle.readline()) - 1
+            else:
+                logFileHandle.seek(start)
+                lineStart = start
+
+            lineDate = None
+            while lineStart < end and lineDate is None:
+                line = logFileHandle.readline()
+                lineDate = getDate(line)
+                if not line:
+                    lineStart = end # The file was truncated
+                elif lineDate is None:
+                    lineStart += len(line)
+
+            if lineStart >= end:
+                end = middle
+            elif lineDate < date:
+                start = lineStart + len(line)
+            else:
+                end = lineStart
+    return start
+
+# Splits large byte ranges, (path, start, stop), of uncompressed log files so that several log readers can process one
+# file. An open ended range stays open ended in its last part in case the file is still being written. Compressed files
+# are split at the checkpoints of their gzip index, if they have one, unless the whole file is cached; they can otherwise
+# only be read from the start.
+def splitLogFileRanges(logFileRanges, chunkSize, gzipIndexes, recordCache):
+    splitRanges = []
+    for accessLogPath, start, stop in logFileRanges:
+        # A whole file that is cached is read from the cache instead
+        if accessLogPath in gzipIndexes and (start or stop is not None or not recordCache or not recordCache.isCached(accessLogPath)):
+            starts = [start] + gzipIndexes[accessLogPath].getSplitOffsets(start, stop, chunkSize)
+        elif isCompressed(accessLogPath):
+            starts = [start]
+        else:
+            end = os.path.getsize(accessLogPath) if stop is None else stop
+            starts = range(start, end, chunkSize) if end - start > chunkSize else [start]
+
+        stops = starts[1:] + [stop]
+        splitRanges.extend([(accessLogPath, partStart, partStop) for partStart, partStop in zip(starts, stops)])
+    return splitRanges
+
 def writePageviewPlotData(hours, minutes, startDate, stopDate, pageviewDataPath, hourly):
     pvDistribution = []
 
@@ -264,6 +461,10 @@ def writePageviewsByDayPlotData(stats, startDate, stopDate, dataFilePath, enviro
 
     nodeIDs = stats.getAllNodes().keys()
     nodeIDs.sort()
+
+    # The days of each node in the plotted range, by date
+    nodeDays = [dict((day.getDate(), day) for day in stats.getNode(nodeID).getDays(firstDay, lastDay)) for nodeID in nodeIDs]
+
     with open (dataFilePath + ".dat", "w") as dataFileHandle:
         print >>dataFileHandle, "       Webapp  Userviews  Asyncviews"
 
@@ -271,28 +472,20 @@ def writePageviewsByDayPlotData(stats, startDate, stopDate, dataFilePath, enviro
             print >>dataFileHandle
             print >>dataFileHandle, currentDay.strftime('"%a, %b %d"')
 
-            # Print data for the first node
-            nodeStats = stats.getNode(nodeIDs[0])
-            nodeDays = nodeStats.getDays(currentDay, nextDay)
-            if nodeDays:
-                userviews = nodeDays[0].getUserviewCount()
-                apiviews = nodeDays[0].getApiviewCount()
-            else:
-                userviews = 0
-                apiviews = 0
-
-            print >>dataFileHandle, "%s %10d %11d" % (currentDay.strftime('"%a, %b %d"'), userviews, apiviews)
-
-            for nodeStats in [stats.getNode(nodeID) for nodeID in nodeIDs[1:]]:
-                nodeDays = nodeStats.getDays(currentDay, nextDay)
-                if nodeDays:
-                    userviews = nodeDays[0].getUserviewCount()
-                    apiviews = nodeDays[0].getApiviewCount()
+            for i in range(len(nodeIDs)):
+                day = nodeDays[i].get(currentDay)
+                if day:
+                    userviews = day.getUserviewCount()
+                    apiviews = day.getApiviewCount()
                 else:
                     userviews = 0
                     apiviews = 0
 
-                print >>dataFileHandle, '           "" %10d %11d' % (userviews, apiviews)
+                # The first node's line is labeled with the day
+                if i == 0:
+                    print >>dataFileHandle, "%s %10d %11d" % (currentDay.strftime('"%a, %b %d"'), userviews, apiviews)
+                else:
+                    print >>dataFileHandle, '           "" %10d %11d' % (userviews, apiviews)
 
             currentDay = nextDay
             nextDay = currentDay + dayDelta
@@ -392,30 +585,101 @@ def shouldRecalculate(options, infoFilePath, dataFilePath, accessLogPaths):
 
     return options.force or not options.ignore and (isDataStale(infoFilePath, dataFilePath, maxMTime) or not optionsMatch(options, info))
 
-def processLogFiles(accessLogPaths, startDate, stopDate, pathRE, agent):
-    workerCount = max(min(multiprocessing.cpu_count() - 1, len(accessLogPaths)), 1)
+# The transaction fields the log readers send to the aggregator. Anything else is dropped in the readers, which also
+# apply the filters.
+def getRecordFields(tree):
+    fields = ['date', 'status', 'time', 'contentType']
 
-    # Start multiprocessing
-    logger.info("Spawning %d log readers for %d access log files", workerCount, len(accessLogPaths))
-    multiprocessing.Process(target = spawnProcessors, args = (accessLogPaths, workerCount)).start()
+    if tree:
+        fields.extend(['method', 'path'])
+    else:
+        fields.append('userAgent') # Userviews and asyncviews exclude WebInject
+
+    # The raw log entry is only reported when debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        fields.append('raw')
+
+    return tuple(fields)
+
+# The log readers only parse the fields of the records and those the filters test. The columnar engine's records are
+# computed from the same fields as the pageview records.
+def getLogParser(recordFields, pathRE, agent):
+    fields = set(recordFields)
+    fields.discard('raw')
 
-    return transactionGenerator(len(accessLogPaths), startDate, stopDate, pathRE, agent)
+    if pathRE:
+        fields.add('path')
+    if agent:
+        fields.add('userAgent')
 
-def spawnProcessors (accessLogPaths, processLimit):
-    for accessLogPath in accessLogPaths:
-        accessLogPathQueue.put(accessLogPath)
+    return LogParser(fields, logger.isEnabledFor(logging.DEBUG))
 
-    workers = [multiprocessing.Process(target = logFileProcessor) for i in range(processLimit)]
+# The cache doesn't keep the raw log entries, which are only needed when debugging
+def getRecordCache(workDir, cacheSize):
+    if cacheSize > 0 and not logger.isEnabledFor(logging.DEBUG):
+        return RecordCache(os.path.join(workDir, "cache"), cacheSize * 1024 * 1024)
+    else:
+        return None
+
+# Starts the log readers and returns a generator of the batches they send, or no batches when seeking to the date range
+# leaves no ranges to read. The ranges are queued for the log readers ahead of a None for each, which tells it there are
+# no more. Each log reader ends what it sends with an EndOfBatches. The log readers are daemons, so they're stopped
+# rather than waited for if the aggregator exits early.
+# With ringFields, the records of each log reader, which are of those fields, are sent through a RecordRing of as many
+# batches as the transaction queue holds.
+def processLogFiles(logFileRanges, startDate, stopDate, pathRE, agent, getRecord, batchSize, readerAgg, chunkSize, tolerance, logParser, recordCache, indexDir, queueSize, ringFields=None, profile=None):
+    gzipIndexes = {}
+    for accessLogPath in set([r[0] for r in logFileRanges]):
+        gzipIndex = GzipIndex.load(indexDir, accessLogPath)
+        if gzipIndex:
+            gzipIndexes[accessLogPath] = gzipIndex
+    logFileRanges = seekLogFileRanges(logFileRanges, startDate, stopDate, tolerance, gzipIndexes)
+    if not logFileRanges:
+        logger.info("None of the access logs have entries in the date range")
+        return []
+
+    logFileCount = len(set([r[0] for r in logFileRanges]))
+    logFileRanges = splitLogFileRanges(logFileRanges, chunkSize, gzipIndexes, recordCache)
+    workerCount = max(min(multiprocessing.cpu_count() - 1, len(logFileRanges)), 1)
+
+    accessLogPathQueue = multiprocessing.Queue()
+    transactionQueue = multiprocessing.Queue(queueSize)
+    rings = [RecordRing(i, ringFields, batchSize, queueSize) if ringFields else None for i in range(workerCount)]
+
+    for logFileRange in logFileRanges:
+        accessLogPathQueue.put(logFileRange)
+
+    for i in range(workerCount):
+        accessLogPathQueue.put(None)
+
+    # Start multiprocessing
+    logger.info("Spawning %d log readers for %d access log files in %d parts", workerCount, logFileCount, len(logFileRanges))
+    workers = [multiprocessing.Process(target = logFileProcessor, args = (accessLogPathQueue, transactionQueue, startDate, stopDate, pathRE, agent, getRecord, batchSize, readerAgg, tolerance, logParser, recordCache, indexDir, rings[i], profile is not None)) for i in range(workerCount)]
 
     for w in workers:
+        w.daemon = True
         w.start()
-    
-    for w in workers:
-        w.join()
-
-    logFilesProcessed.value = True
 
-def transactionGenerator(logFileCount, startDate, stopDate, pathRE, agent):
+    return batchGenerator(transactionQueue, workers, rings, profile)
+
+# The last message of each log reader, with the traceback of the error that stopped it, if one did, and its profile, if
+# profiling
+class EndOfBatches:
+    def __init__(self, pid, error, profile):
+        self.pid = pid
+        self.error = error
+        self.profile = profile
+
+# Log readers send batches of (node, payload, passed count, unparsed lines, filtered count, out of range count). The
+# payload is either a list of records or, when the readers aggregate, the log file path and the minute Instants of one
+# log file range. Each record is what getRecord returns for one transaction that passed the filters: the values of
+# recordFields, or for the columnar engine its minute, view class and time. The node is sent once per batch and unused
+# fields and rejected lines are never pickled. The log readers pickle the batches themselves, so that the time spent
+# pickling them can be told apart from the time spent sending them.
+#
+# Batches are read until every log reader has sent its EndOfBatches. A log reader that failed, or exited without
+# sending one, stops the others and the run.
+def batchGenerator(transactionQueue, workers, rings, profile=None):
     start = datetime.datetime.now()
     blockStart = datetime.datetime.now()
     blockLines = 0
@@ -423,45 +687,93 @@ def transactionGenerator(logFileCount, startDate, stopDate, pathRE, agent):
     passedCount = 0
     failedToParseCount = 0
     failedDateRangeCount = 0
-    while not transactionQueue.empty() or not logFilesProcessed.value:
+    runningWorkers = dict((w.pid, w) for w in workers)
+    exitedWorkers = set() # Found to have exited when none sent a batch
+    while runningWorkers:
         try:
-            transaction = transactionQueue.get(timeout=2)
-
-            totalLines += 1
-            blockLines += 1
-            if totalLines % 100000 == 0:
-                logger.info("%s httpd access log entries read (%s per second)", "{:,}".format(totalLines), "{:,}".format(int(blockLines / (datetime.datetime.now() - blockStart).total_seconds())))
-                blockStart = datetime.datetime.now()
-                blockLines = 0
-
-            if not transaction.isValid():
-                logger.warn("Skipping log entry because it cannot be parsed:\n\t%s", transaction.getRaw())
-                failedToParseCount += 1
-                continue
+            message = receiveBatch(transactionQueue, rings, profile)
+        except Queue.Empty:
+            # What a log reader sends is in the queue before it exits, so one found to have exited twice in a row exited
+            # without ending its batches
+            for pid, w in runningWorkers.items():
+                if not w.is_alive():
+                    if pid in exitedWorkers:
+                        stopLogReaders(workers, "Log reader %d exited with code %s before it finished" % (pid, w.exitcode))
+                    exitedWorkers.add(pid)
+            continue
 
-            if pathRE and not pathRE.match(transaction.path):
-                logger.debug("Skipping log entry because the path doesn't match the specified pattern:\n\t%s", transaction.getRaw())
-                continue
+        if isinstance(message, EndOfBatches):
+            if message.error:
+                stopLogReaders(workers, "Log reader %d failed:\n%s" % (message.pid, message.error))
+            if profile:
+                profile.addWorker(message.profile)
+            runningWorkers.pop(message.pid).join()
+            continue
 
-            if agent and not transaction.userAgent == agent:
-                logger.debug("Skipping log entry because the user agent does not match that provided:\n\t%s", transaction.getRaw())
-                continue
+        node, payload, batchPassedCount, unparsed, filteredCount, outOfRangeCount = message
 
-            if (startDate and transaction.date < startDate) or (stopDate and transaction.date >= stopDate):
-                logger.debug("Skipping log entry because it is not in the specificed date range:\n\t%s", transaction.getRaw())
-                failedDateRangeCount += 1
-                continue
+        batchLines = batchPassedCount + len(unparsed) + filteredCount + outOfRangeCount
+        totalLines += batchLines
+        blockLines += batchLines
+        if totalLines / 100000 > (totalLines - batchLines) / 100000:
+            logger.info("%s httpd access log entries read (%s per second)", "{:,}".format(totalLines), "{:,}".format(int(blockLines / (datetime.datetime.now() - blockStart).total_seconds())))
+            blockStart = datetime.datetime.now()
+            blockLines = 0
 
-            passedCount += 1
-            yield transaction
-        except Queue.Empty:
-            logger.warn("The transaction queue is empty. Probably just a timing issue; will test for the end condition again.")
+        for raw in unparsed:
+            logger.warn("Skipping log entry because it cannot be parsed:\n\t%s", raw)
+            failedToParseCount += 1
+
+        failedDateRangeCount += outOfRangeCount
+        passedCount += batchPassedCount
+
+        yield node, payload
+
+    if not totalLines:
+        logger.info("No new httpd access log entries were read")
+        return
 
     skippedCount = totalLines - passedCount
     logger.info("Processed %s transactions; skipped %s (%.2f%%).", "{:,}".format(totalLines), "{:,}".format(skippedCount), 100. * skippedCount / totalLines)
     if skippedCount > 0:
         logger.info("Of the transactions skipped, %.2f%% were outside the date range, and %.2f%% could not be parsed.", 100. * failedDateRangeCount / skippedCount, 100. * failedToParseCount / skippedCount)
 
+# Returns the next batch or EndOfBatches from the log readers; raises Queue.Empty if none arrives in time
+def receiveBatch(transactionQueue, rings, profile):
+    if not profile:
+        return decodeBatch(transactionQueue.get(timeout=logReaderCheckInterval), rings)
+
+    profile.sampleQueueDepth(transactionQueue)
+    stage = profile.switch('wait')
+    try:
+        message = transactionQueue.get(timeout=logReaderCheckInterval)
+        profile.switch('unpickle')
+        return decodeBatch(message, rings)
+    finally:
+        profile.switch(stage)
+
+# Unpickles a batch and reads its records from the log reader's ring if they were sent through one
+def decodeBatch(message, rings):
+    if isinstance(message, EndOfBatches):
+        return message
+
+    batch = pickle.loads(message)
+    if isinstance(batch[1], RingBatch):
+        batch = (batch[0], rings[batch[1].ring].read(batch[1])) + batch[2:]
+    return batch
+
+def stopLogReaders(workers, errorMsg):
+    logger.error(errorMsg)
+    for w in workers:
+        if w.is_alive():
+            w.terminate()
+    exit(6)
+
+def transactionGenerator(batchGenerator, recordFields):
+    for node, records in batchGenerator:
+        for record in records:
+            yield Transaction.fromRecord(recordFields, record, node)
+
 def getStats(transactionGenerator):
     stats = {}
     for transaction in transactionGenerator:
@@ -478,23 +790,226 @@ def getStats(transactionGenerator):
 
     return aggStats
 
-def logFileProcessor():
-    while not accessLogPathQueue.empty():
-        try:
-            accessLogPath = accessLogPathQueue.get(False)  
+# Loads partial stats files, as (path, PartialStats), and exits if any can't be merged. Their minutes must hold the
+# transaction times in the same form, which is that of the sketch accuracy when it's given. The stats of a node found in
+# more than one file are only merged once.
+def loadPartialStats(paths, sketchAccuracy):
+    if not paths:
+        logger.error("No partial stats files given to merge")
+        exit(2)
+
+    partialStats = []
+    nodePaths = {}
+    for path in paths:
+        p = PartialStats.load(path)
+        if not p:
+            exit(7)
+
+        if sketchAccuracy and p.sketchAccuracy != sketchAccuracy or partialStats and p.sketchAccuracy != partialStats[0][1].sketchAccuracy:
+            logger.error("The transaction times in %s were summarized %s. Every partial stats file must be written with the same -S.", path, "by sketches of accuracy %g" % p.sketchAccuracy if p.sketchAccuracy else "without sketches")
+            exit(7)
+        if partialStats and p.filterDigest != partialStats[0][1].filterDigest:
+            logger.warn("The stats in %s were aggregated with other filters or dates than those in %s", path, partialStats[0][0])
+
+        for node in p.nodes.keys():
+            if node in nodePaths:
+                logger.warn("The stats of %s are in both %s and %s; only the first are merged", node, nodePaths[node], path)
+                del p.nodes[node]
+            else:
+                nodePaths[node] = path
 
-            logger.info("Processing %s", accessLogPath)
+        logger.info("Merging the stats of %d nodes of %s from %s", len(p.nodes), p.host, path)
+        partialStats.append((path, p))
+    return partialStats
 
-            for line in logFile(accessLogPath):
-                transactionQueue.put(Transaction(line.rstrip(), os.path.dirname(accessLogPath)))
+# Merges the per log file minutes aggregated by the log readers
+def mergeStats(batchGenerator):
+    stats = {}
+    for node, (accessLogPath, minutes) in batchGenerator:
+        if not node in stats:
+            stats[node] = Stats()
 
-            logger.info("Finished processing %s", accessLogPath)
-        except Queue.Empty:
-            logger.warn("The access log queue is empty. Probably just a timing issue.")
+        nodeStats = stats[node]
+        for minute in minutes:
+            nodeStats.aggMinute(minute)
+
+    logger.info("Aggregating stats")
+    aggStats = Stats()
+    for node in stats:
+        aggStats.aggNode(node, stats[node])
 
+    return aggStats
+
+# Yields the transactions of a log file range, from the cache when the whole compressed file was parsed before. Whole
+# compressed files are parsed in full so that the cache serves any mode and filters. Uncompressed log files aren't
+# cached: the live log changes on every run, and scanning them in place, with the date range narrowed first, is cheaper
+# than loading a cache.
+def readTransactions(accessLogPath, start, stop, startDate, stopDate, tolerance, logParser, recordCache, indexDir, stageTimes=None):
+    node = os.path.dirname(accessLogPath)
+    wholeFile = not start and stop is None
+
+    if recordCache and wholeFile and isCompressed(accessLogPath):
+        cachedTransactions = recordCache.load(accessLogPath, node)
+        if cachedTransactions is not None:
+            return cachedTransactions
+        lines = logFile(accessLogPath, indexDir=indexDir)
+        return recordCache.cacheTransactions(accessLogPath, parseLogEntries(stageTimes.timedLines(lines) if stageTimes else lines, node, fullParser, None, None, tolerance))
+
+    if not isCompressed(accessLogPath):
+        return scanLogEntries(accessLogPath, start, stop, node, logParser, startDate, stopDate, tolerance, stageTimes)
+
+    lines = logFile(accessLogPath, start, stop, indexDir)
+    return parseLogEntries(stageTimes.timedLines(lines) if stageTimes else lines, node, logParser, startDate, stopDate, tolerance)
+
+# Yields the transactions of log entries. Entries outside of the date range aren't parsed; their transactions only have a
+# date, which is all the log readers look at before skipping them. Reading stops at the first entry more than the
+# tolerance past the stop date; the rest of the log can't hold entries within the date range.
+def parseLogEntries(lines, node, logParser, startDate, stopDate, tolerance):
+    for line in lines:
+        raw = line.rstrip()
+        date = getDateOutsideRange(raw, startDate, stopDate) if startDate or stopDate else None
+        if date is None:
+            yield Transaction(raw, node, logParser)
+        elif stopDate and date >= stopDate + tolerance:
+            return
+        else:
+            yield Transaction.fromRecord(('date', 'raw'), (date, raw if logParser.keepRaw else None), node)
+
+# Yields the transactions of the lines of an uncompressed log file that start within [start, stop), as parseLogEntries
+# does, by scanning the memory mapped file with the parser's scan expression. No string is made of a line; only the
+# fields are taken from it, and the date alone of an entry outside of the date range. Lines that can't be parsed are
+# found between the matches. As the file is read by the scan, the time spent reading it counts as parsing when profiling.
+def scanLogEntries(path, start, stop, node, logParser, startDate, stopDate, tolerance, stageTimes=None):
+    with open(path, 'rb') as logFileHandle:
+        size = os.fstat(logFileHandle.fileno()).st_size
+        if not size:
+            return
+        buffer = mmap.mmap(logFileHandle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        # A line straddling start belongs to the previous range and one straddling stop to this one
+        position = 0
+        if start > 0:
+            position = buffer.find("\n", start - 1) + 1 or size
+        end = size
+        if stop is not None and stop < size:
+            end = buffer.find("\n", stop - 1) + 1 or size
+        if stageTimes:
+            stageTimes.bytes += max(end - position, 0)
+
+        for match in logParser.scanExpression.finditer(buffer, position, end):
+            if match.start() > position:
+                for raw in buffer[position:match.start() - 1].split("\n"):
+                    yield Transaction(raw.rstrip(), node, logParser)
+            position = match.end() + 1
+
+            if startDate or stopDate:
+                date = parseDate(match.group('date'))
+                if stopDate and date >= stopDate + tolerance:
+                    return
+                elif (startDate and date < startDate) or (stopDate and date >= stopDate):
+                    yield Transaction.fromRecord(('date', 'raw'), (date, match.group(0).rstrip() if logParser.keepRaw else None), node)
+                    continue
+
+            yield Transaction.fromMatch(match, node, logParser)
+
+        if position < end:
+            for raw in buffer[position:end - 1 if buffer[end - 1] == "\n" else end].split("\n"):
+                yield Transaction(raw.rstrip(), node, logParser)
+    finally:
+        buffer.close()
+
+# When profiling, the time spent in each stage is charged to filtering unless it's spent reading, parsing, pickling or
+# sending. An error stops the log reader; its traceback is sent to the aggregator in place of the rest of the batches.
+def logFileProcessor(accessLogPathQueue, transactionQueue, startDate, stopDate, pathRE, agent, getRecord, batchSize, readerAgg, tolerance, logParser, recordCache, indexDir, ring, profile):
+    stageTimes = StageTimes('filter') if profile else None
+    worker = {'pid': os.getpid(), 'ranges': 0, 'lines': 0}
+
+    error = None
+    try:
+        # The log file ranges are followed by a None for each log reader
+        for accessLogPath, start, stop in iter(accessLogPathQueue.get, None):
+            logger.info("Processing %s (bytes %d to %s)", accessLogPath, start, "end" if stop is None else stop)
+
+            node = os.path.dirname(accessLogPath)
+            nodeStats = Stats()
+            records = []
+            passedCount = 0
+            unparsed = []
+            filteredCount = 0
+            outOfRangeCount = 0
+            transactions = readTransactions(accessLogPath, start, stop, startDate, stopDate, tolerance, logParser, recordCache, indexDir, stageTimes)
+            if stageTimes:
+                transactions = stageTimes.timed('parse', transactions)
+
+            for transaction in transactions:
+                if not transaction.isValid():
+                    unparsed.append(transaction.getRaw())
+                elif (startDate and transaction.date < startDate) or (stopDate and transaction.date >= stopDate):
+                    # Tested before the filters, which need fields that aren't parsed for entries out of the date range
+                    logger.debug("Skipping log entry because it is not in the specificed date range:\n\t%s", transaction.getRaw())
+                    outOfRangeCount += 1
+                elif pathRE and not pathRE.match(transaction.path):
+                    logger.debug("Skipping log entry because the path doesn't match the specified pattern:\n\t%s", transaction.getRaw())
+                    filteredCount += 1
+                elif agent and not transaction.userAgent == agent:
+                    logger.debug("Skipping log entry because the user agent does not match that provided:\n\t%s", transaction.getRaw())
+                    filteredCount += 1
+                else:
+                    passedCount += 1
+                    if readerAgg:
+                        nodeStats.agg(transaction)
+                    else:
+                        records.append(getRecord(transaction))
+
+                if not readerAgg and passedCount + len(unparsed) + filteredCount + outOfRangeCount >= batchSize:
+                    sendBatch((node, records, passedCount, unparsed, filteredCount, outOfRangeCount), transactionQueue, ring, stageTimes, worker)
+                    records = []
+                    passedCount = 0
+                    unparsed = []
+                    filteredCount = 0
+                    outOfRangeCount = 0
+
+            # Partial aggregates are sent once per log file. The hours and days are rebuilt from the minutes when merged.
+            if readerAgg:
+                sendBatch((node, (accessLogPath, nodeStats.getAllMinutes()), passedCount, unparsed, filteredCount, outOfRangeCount), transactionQueue, ring, stageTimes, worker)
+            elif passedCount or unparsed or filteredCount or outOfRangeCount:
+                sendBatch((node, records, passedCount, unparsed, filteredCount, outOfRangeCount), transactionQueue, ring, stageTimes, worker)
+
+            worker['ranges'] += 1
+            logger.info("Finished processing %s (bytes %d to %s)", accessLogPath, start, "end" if stop is None else stop)
+    except Exception:
+        error = traceback.format_exc()
+
+    if stageTimes:
+        worker['stages'] = stageTimes.getStages()
+        worker['wall'] = sum([s['wall'] for s in worker['stages'].values()])
+        worker['cpu'] = sum([s['cpu'] for s in worker['stages'].values()])
+        worker['bytes'] = stageTimes.bytes
+
+    transactionQueue.put(EndOfBatches(os.getpid(), error, worker if stageTimes else None))
     transactionQueue.close()
     transactionQueue.join_thread()
 
+# Records sent through a ring are written to it when it has a free slot; waiting for one counts as sending
+def sendBatch(batch, transactionQueue, ring, stageTimes, worker):
+    worker['lines'] += batch[2] + len(batch[3]) + batch[4] + batch[5]
+    if ring and batch[1]:
+        if stageTimes:
+            stageTimes.switch('send')
+        slot = ring.acquireSlot()
+        if stageTimes:
+            stageTimes.switch('pickle')
+        batch = (batch[0], ring.write(slot, batch[1])) + batch[2:]
+    elif stageTimes:
+        stageTimes.switch('pickle')
+    data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+    if stageTimes:
+        stageTimes.switch('send')
+    transactionQueue.put(data)
+    if stageTimes:
+        stageTimes.switch('filter')
+
 def writePlotInfo(options, minutes, startDate, stopDate, infoFilePath):
     # Calculate additional plot data
     transactionTotal = 0
@@ -600,23 +1115,59 @@ def setLoggingLevel(loggingLevel):
     loggingFormatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s - %(message)s')
     loggingHandler.setFormatter(loggingFormatter)
 
-    for loggerName in ["main", "tree"]:
+    for loggerName in ["main", "tree", "reader", "cache", "incremental", "gzindex", "columnar", "partial"]:
         logger = logging.getLogger(loggerName)
         logger.setLevel(loggingLevel)
         logger.addHandler(loggingHandler)
 
-def validateOptions(workDir, startDate, stopDate, usage):
+def validateOptions(options, startDate, stopDate, usage):
     errorMsgs = []
 
-    if not workDir:
+    if not options.workDir:
         errorMsgs.append(usage.rstrip())
-    elif not os.path.isdir(workDir):
-        errorMsgs.append("The specified working directory, '%s', must exist." % workDir)
+    elif not os.path.isdir(options.workDir):
+        errorMsgs.append("The specified working directory, '%s', must exist." % options.workDir)
 
     if startDate and stopDate:
         if not startDate < stopDate:
             errorMsgs.append("The start date must be earlier than the stop date.")
 
+    if options.tree and options.incremental:
+        errorMsgs.append("The request tree cannot be built incrementally.")
+
+    if options.tolerance < 0:
+        errorMsgs.append("The tolerance must be a positive number of minutes.")
+
+    if options.chunkSize < 1:
+        errorMsgs.append("The chunk size must be at least one MB.")
+
+    if options.batchSize < 1:
+        errorMsgs.append("The batch size must be at least one log entry.")
+
+    if options.queueSize < 1:
+        errorMsgs.append("The queue size must be at least one batch.")
+
+    if options.sketchAccuracy is not None and not 0 < options.sketchAccuracy < 1:
+        errorMsgs.append("The sketch accuracy must be between 0 and 1, e.g. 0.01.")
+
+    if options.numpy:
+        if not ColumnarStats.isAvailable():
+            errorMsgs.append("NumPy must be installed to aggregate pageview stats in NumPy arrays.")
+        if options.tree or options.incremental or options.readerAgg or options.sketchAccuracy:
+            errorMsgs.append("Stats aggregated in NumPy arrays cannot be combined with the request tree, incremental runs, reader aggregation or sketches.")
+
+    if options.emitPartial and options.merge:
+        errorMsgs.append("Partial stats can be either written or merged, not both.")
+
+    if (options.emitPartial or options.merge) and (options.tree or options.numpy):
+        errorMsgs.append("Partial stats cannot be combined with the request tree or NumPy arrays.")
+
+    if options.merge and (options.incremental or options.ring):
+        errorMsgs.append("Merging partial stats reads no access logs, so it cannot be incremental or use ring buffers.")
+
+    if options.ring and (options.numpy or options.incremental or options.emitPartial or options.readerAgg and not options.tree):
+        errorMsgs.append("Only the records of the pageview and request tree modes can be sent through ring buffers, not NumPy records or aggregates.")
+
     return errorMsgs
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+import gzip
+import logging
+import os
+import zlib
+import cPickle as pickle # Changed to "pickle" in Python 3
+
+logger = logging.getLogger('partial')
+
+# The minutes aggregated from the access logs of one host, by node, so that the stats of a cluster can be merged on one
+# host from files written next to each node's logs rather than from copies of the logs. Nodes are named by host and log
+# directory, since every host may keep its logs in the same directory.
+#
+# The minutes depend on the filters applied by the log readers and on the sketch accuracy. Files written with different
+# filters can still be merged; files written with different sketch accuracies cannot.
+class PartialStats:
+    version = 1
+
+    def __init__(self, host, filterDigest, sketchAccuracy, nodes):
+        self.host = host
+        self.filterDigest = filterDigest
+        self.sketchAccuracy = sketchAccuracy
+        self.nodes = nodes
+
+    @staticmethod
+    def fromStats(host, filterDigest, sketchAccuracy, stats):
+        nodes = {}
+        for node, nodeStats in stats.getAllNodes().items():
+            nodes["%s:%s" % (host, node)] = nodeStats.getMinutes(None, None)
+        return PartialStats(host, filterDigest, sketchAccuracy, nodes)
+
+    # Returns the partial stats written to a file, or None if it can't be read
+    @staticmethod
+    def load(path):
+        try:
+            with gzip.open(path, "rb") as partialFileHandle:
+                version, host, filterDigest, sketchAccuracy, nodes = pickle.load(partialFileHandle)
+        except (IOError, EOFError, ValueError, TypeError, AttributeError, zlib.error, pickle.UnpicklingError) as e:
+            logger.error("Unable to read the partial stats in %s: %s", path, e)
+            return None
+
+        if version != PartialStats.version:
+            logger.error("%s was written by another version of the partial stats format", path)
+            return None
+
+        return PartialStats(host, filterDigest, sketchAccuracy, nodes)
+
+    def write(self, path):
+        temporaryPath = "%s.%d" % (path, os.getpid())
+        with gzip.open(temporaryPath, "wb") as partialFileHandle:
+            pickle.dump((PartialStats.version, self.host, self.filterDigest, self.sketchAccuracy, self.nodes), partialFileHandle, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporaryPath, path)
+
+    # Yields the minutes of every node in the form the log readers send them, (node, (path, minutes))
+    def getBatches(self, path):
+        for node, minutes in self.nodes.items():
+            yield node, (path, minutes)
@@ -8,7 +8,10 @@ from textwrap import dedent
 
 logger = logging.getLogger('profile')
 
-class Node:
+# There is a node for every distinct collapsed path, so nodes have slots rather than a dict
+class Node(object):
+    __slots__ = ('path', 'children', 'reads', 'executions', 'readTime', 'executionTime', 'method', 'contentType', 'status')
+
     def __init__(self, path):
         self.path = path
         self.children = {}
@@ -87,6 +90,48 @@ class Node:
     def isLeaf(self):
         return self.reads > 0
 
+# Collapses resource paths to the first path pattern they match or, failing that, replaces the IDs in them with *. The
+# patterns are compiled into one alternation with a group per pattern, so matching a path is a single regex match rather
+# than one per pattern; the first alternative that matches the whole path wins, as in the order of the patterns. Python
+# 2's re allows 100 groups per expression, so longer pattern lists are split between several expressions tried in turn.
+#
+# The same paths recur constantly, so the collapsed paths are cached. The cache is approximately least recently used:
+# when the recent paths fill it, they become the old paths and the previous old paths are dropped. An old path that is
+# used again moves back to the recent paths.
+class PathCollapser:
+    patternsPerExpression = 99
+    cacheSize = 50000
+
+    def __init__(self, pathPatterns):
+        self.expressions = []
+        for i in range(0, len(pathPatterns), PathCollapser.patternsPerExpression):
+            patterns = pathPatterns[i:i + PathCollapser.patternsPerExpression]
+            expression = re.compile("^(?:%s)$" % "|".join(["(%s)" % Tree.getPathRE(p) for p in patterns]))
+            self.expressions.append((expression, patterns))
+
+        self.recentPaths = {}
+        self.oldPaths = {}
+
+    def collapse(self, path):
+        collapsedPath = self.recentPaths.get(path)
+        if collapsedPath is None:
+            collapsedPath = self.oldPaths.get(path)
+            if collapsedPath is None:
+                collapsedPath = self.match(path)
+
+            if len(self.recentPaths) >= PathCollapser.cacheSize:
+                self.oldPaths = self.recentPaths
+                self.recentPaths = {}
+            self.recentPaths[path] = collapsedPath
+        return collapsedPath
+
+    def match(self, path):
+        for expression, patterns in self.expressions:
+            matchedPath = expression.match(path)
+            if matchedPath:
+                return patterns[matchedPath.lastindex - 1]
+        return Tree.idPattern.sub("*", path)
+
 class Tree:
     dateFormat = "%H:%M, %b %d"
     idPattern = re.compile("(?<=/)[0-9-]{4,}(?=/|$)")
@@ -242,9 +287,10 @@ class Tree:
         self.root = Node("")
         self.leaves = []
         sitePathPatterns = ["/%s%s" % (context, p) for p in Tree.pathPatterns] if context else Tree.pathPatterns
-        sitePathREPatterns = [(re.compile("^%s$" % re.sub("\*{1,2}|/", lambda x: {"**": ".*", "*": "[^/]+", "/": "/+"}[x.group()], s)), s) for s in sitePathPatterns]
+        pathCollapser = PathCollapser(sitePathPatterns)
         queryStart = re.compile('\?')
         pathDelimiter = re.compile('/+')
+        pathSteps = {} # The steps of recent collapsed paths, shared by their transactions
         skippedCount = 0
         totalCount = 0
 
@@ -262,9 +308,13 @@ class Tree:
                     lastDate = transaction.date
 
                 resourceURL = queryStart.split(transaction.path, maxsplit=1)[0]
-                simplifiedURL = Tree.collapsePath(resourceURL, sitePathREPatterns)
-                steps = pathDelimiter.split(simplifiedURL)
-                self.addLeaf(self.root, steps[1:], transaction)
+                simplifiedURL = pathCollapser.collapse(resourceURL)
+                steps = pathSteps.get(simplifiedURL)
+                if steps is None:
+                    if len(pathSteps) >= PathCollapser.cacheSize:
+                        pathSteps.clear()
+                    steps = pathSteps[simplifiedURL] = tuple([intern(s) for s in pathDelimiter.split(simplifiedURL)[1:]]) # Changed to "sys.intern" in Python 3
+                self.addLeaf(self.root, steps, transaction)
             totalCount += 1
 
         logger.info("Skipped %d transactions (%.2f%%)", skippedCount, 100. * skippedCount / totalCount)
@@ -280,25 +330,24 @@ class Tree:
         else:
             self.stopDate = stopDate
             
+    # Adds a transaction to the node at the end of path, a sequence of steps, below parent. Every node on the way counts an
+    # execution; the node at the end counts a read, and becomes a leaf on its first one.
     def addLeaf(self, parent, path, transaction):
-        if len(path) > 0:
-            parent.incrementExecutions(transaction.time)
-
-            step = path[0]
-
-            children = parent.getChildren()
-            if children.has_key(step):
-                thisNode = children[step]
-            else:
-                thisNode = Node(parent.path + "/" + step)
-                children[step] = thisNode
-
-            self.addLeaf(thisNode, path[1:], transaction)
-        else:
-            if parent.getReads() == 0:
-                self.leaves.append(parent)
-                parent.setTransaction(transaction)
-            parent.incrementReads(transaction.time)
+        time = transaction.time
+        node = parent
+        for step in path:
+            node.incrementExecutions(time)
+
+            children = node.children
+            child = children.get(step)
+            if child is None:
+                child = children[step] = Node(node.path + "/" + step)
+            node = child
+
+        if node.reads == 0:
+            self.leaves.append(node)
+            node.setTransaction(transaction)
+        node.incrementReads(time)
 
     def printSummary(self): 
         print "Transactions ordered by the sum of executions and reads."
@@ -456,12 +505,10 @@ class Tree:
         for t in sorted(loadTestRequests, cmp=lambda x, y: x.reads - y.reads, reverse=True):
             print "  {:s} {:6d} hits, {:5.2f}%".format(t.getDisplayPath().ljust(100), t.reads, t.reads / float(loadTestReads) * 100)
 
+    # Returns the regular expression source matching the paths of a path pattern, where * is one step and ** any number
     @staticmethod
-    def collapsePath(path, sitePathREPatterns):
-        for c in sitePathREPatterns:
-            if c[0].match(path):
-                return c[1]
-        return Tree.idPattern.sub("*", path)
+    def getPathRE(pathPattern):
+        return re.sub("\*{1,2}|/", lambda x: {"**": ".*", "*": "[^/]+", "/": "/+"}[x.group()], pathPattern)
 
     @staticmethod
     def printTree(node, depth, limit):
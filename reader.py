@@ -0,0 +1,129 @@
+#!/usr/bin/python
+import bz2
+import logging
+import subprocess
+import threading
+import zlib
+import Queue # Changed to "queue" in Python 3
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None # xz compressed logs are decompressed by the xz command instead
+
+logger = logging.getLogger('reader')
+
+compressedExtensions = ('.gz', '.bz2', '.xz')
+
+def isCompressed(path):
+    return path.endswith(compressedExtensions)
+
+def decompressor(path):
+    if path.endswith('.gz'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif path.endswith('.bz2'):
+        return bz2.BZ2Decompressor()
+    else:
+        return lzma.LZMADecompressor()
+
+def openCompressed(path, blocks=None):
+    if blocks is None and path.endswith('.xz') and not lzma:
+        return subprocess.Popen(["xz", "--decompress", "--stdout", path], shell=False, bufsize=-1, stdout=subprocess.PIPE).stdout
+    else:
+        return DecompressingReader(path, blocks)
+
+# Yields the decompressed blocks of a compressed file. Concatenated streams, as written by logrotate's compress and
+# delaycompress, are decompressed one after another.
+def decompressBlocks(path):
+    with open(path, 'rb') as compressedFileHandle:
+        stream = decompressor(path)
+        data = compressedFileHandle.read(DecompressingReader.blockSize)
+        while data:
+            try:
+                yield stream.decompress(data)
+            except EOFError:
+                # The previous stream ended exactly at the end of the last block
+                stream = decompressor(path)
+                yield stream.decompress(data)
+
+            # The rest of the data belongs to the next stream
+            while stream.unused_data:
+                data = stream.unused_data
+                stream = decompressor(path)
+                yield stream.decompress(data)
+
+            data = compressedFileHandle.read(DecompressingReader.blockSize)
+
+        if hasattr(stream, 'flush'):
+            yield stream.flush()
+
+# Iterates over the lines of a compressed log file. A thread reads and decompresses large blocks ahead of the reader, so
+# decompression, which releases the GIL, overlaps with parsing the lines already decompressed. The blocks are those of
+# decompressBlocks unless others are given, e.g. from a gzip index.
+class DecompressingReader:
+    blockSize = 256 * 1024 # Compressed bytes per read
+    queueSize = 16 # Decompressed blocks buffered ahead of the reader
+
+    def __init__(self, path, blocks=None):
+        self.path = path
+        self.source = decompressBlocks(path) if blocks is None else blocks
+        self.blocks = Queue.Queue(DecompressingReader.queueSize)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.decompress, name="decompress %s" % path)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def decompress(self):
+        try:
+            for block in self.source:
+                if self.closed.is_set():
+                    break
+                self.put(block)
+            self.put(None)
+        except Exception as e:
+            self.put(e)
+        finally:
+            self.source.close()
+
+    def put(self, block):
+        if block != "":
+            while not self.closed.is_set():
+                try:
+                    self.blocks.put(block, timeout=1)
+                    return
+                except Queue.Full:
+                    pass
+
+    def close(self):
+        self.closed.set()
+
+        # Make room for a pending block so the thread notices it should stop
+        try:
+            while True:
+                self.blocks.get_nowait()
+        except Queue.Empty:
+            pass
+        self.thread.join()
+
+    def __iter__(self):
+        try:
+            remainder = ""
+            while True:
+                block = self.blocks.get()
+                if block is None:
+                    break
+                elif isinstance(block, Exception):
+                    raise block
+
+                lines = (remainder + block).split("\n")
+                remainder = lines.pop()
+                for line in lines:
+                    yield line + "\n"
+
+            if remainder:
+                yield remainder
+        finally:
+            self.close()
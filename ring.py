@@ -0,0 +1,123 @@
+#!/usr/bin/python
+import datetime
+import mmap
+import multiprocessing
+import struct
+
+epoch = datetime.datetime.utcfromtimestamp(0)
+
+# What a log reader sends through the transaction queue in place of the records of a batch: the slot of its ring they're
+# in, how many there are and the strings it added to its table for them
+class RingBatch:
+    def __init__(self, ring, slot, count, reset, newStrings):
+        self.ring = ring
+        self.slot = slot
+        self.count = count
+        self.reset = reset
+        self.newStrings = newStrings
+
+# A ring of slots in memory shared by a log reader and the aggregator, through which the reader sends the records of its
+# batches without pickling them. Each slot holds the records of one batch by field: dates as seconds since the epoch,
+# times as they are, and every other field, such as the status, content type or path, as its index in a table of the
+# strings the reader has sent. The reader sends the strings new to the table along with the slot, through the
+# transaction queue, and starts a new table once it holds tableLimit strings so that it needn't hold every distinct path
+# of a log.
+#
+# The ring is created before the log reader is forked so both map the same memory. Slots are used in turn and the
+# aggregator reads them in the order they were written; the reader waits for a free one when all of them hold records
+# the aggregator hasn't read.
+class RecordRing:
+    fieldCodes = {'date': 'q', 'time': 'q'} # Other fields are string table indexes, 'I'
+    tableLimit = 65536
+
+    def __init__(self, index, recordFields, batchSize, slotCount):
+        self.index = index
+        self.fields = recordFields
+        self.codes = [RecordRing.fieldCodes.get(f, 'I') for f in recordFields]
+        self.slotSize = sum([struct.calcsize("<" + c) for c in self.codes]) * batchSize
+        self.slotCount = slotCount
+        self.buffer = mmap.mmap(-1, self.slotSize * slotCount)
+        self.freeSlots = multiprocessing.Semaphore(slotCount)
+
+        # The log reader's end
+        self.nextSlot = 0
+        self.stringIds = {}
+
+        # The aggregator's end
+        self.strings = []
+        self.dates = {}
+
+    # The raw log entries kept when debugging aren't sent through rings
+    @staticmethod
+    def isSupported(recordFields):
+        return not 'raw' in recordFields
+
+    # Waits for a free slot and returns it
+    def acquireSlot(self):
+        self.freeSlots.acquire()
+        slot = self.nextSlot
+        self.nextSlot = (slot + 1) % self.slotCount
+        return slot
+
+    # Writes a batch of records, tuples of the values of the record fields, to a slot
+    def write(self, slot, records):
+        reset = len(self.stringIds) >= RecordRing.tableLimit
+        if reset:
+            self.stringIds = {}
+
+        newStrings = []
+        offset = slot * self.slotSize
+        for field, code, column in zip(self.fields, self.codes, zip(*records)):
+            if field == 'date':
+                column = self.getSeconds(column)
+            elif code == 'I':
+                column = self.getStringIds(column, newStrings)
+
+            struct.pack_into("<%d%s" % (len(records), code), self.buffer, offset, *column)
+            offset += struct.calcsize("<" + code) * len(records)
+
+        return RingBatch(self.index, slot, len(records), reset, newStrings)
+
+    # Reads the records of a batch, straight from the shared memory, and frees its slot
+    def read(self, batch):
+        if batch.reset:
+            self.strings = []
+        self.strings.extend(batch.newStrings)
+
+        columns = []
+        offset = batch.slot * self.slotSize
+        for field, code in zip(self.fields, self.codes):
+            column = struct.unpack_from("<%d%s" % (batch.count, code), self.buffer, offset)
+            offset += struct.calcsize("<" + code) * batch.count
+
+            if field == 'date':
+                column = self.getDates(column)
+            elif code == 'I':
+                column = map(self.strings.__getitem__, column)
+            columns.append(column)
+
+        self.freeSlots.release()
+        return zip(*columns)
+
+    def getStringIds(self, strings, newStrings):
+        for s in set(strings).difference(self.stringIds):
+            self.stringIds[s] = len(self.stringIds)
+            newStrings.append(s)
+        return map(self.stringIds.__getitem__, strings)
+
+    # The dates of a batch are mostly of the same few minutes, so their seconds are computed once per batch
+    @staticmethod
+    def getSeconds(dates):
+        seconds = {}
+        for date in set(dates):
+            delta = date - epoch
+            seconds[date] = delta.days * 86400 + delta.seconds
+        return map(seconds.__getitem__, dates)
+
+    def getDates(self, seconds):
+        if len(self.dates) > 86400:
+            self.dates.clear()
+
+        for s in set(seconds).difference(self.dates):
+            self.dates[s] = epoch + datetime.timedelta(seconds=s)
+        return map(self.dates.__getitem__, seconds)
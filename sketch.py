@@ -0,0 +1,140 @@
+#!/usr/bin/python
+import array
+import math
+
+# A mergeable summary of transaction times in the manner of DDSketch. The first times are kept as they are, in an
+# array. Past exactLimit times, they are counted in logarithmically sized buckets instead, bucket i holding the times in
+# (gamma^(i-1), gamma^i] where gamma = (1 + accuracy) / (1 - accuracy). A sketch therefore holds at most
+# log(max / min) / log(gamma) counts however many times it summarizes: about 1,000 for times from 1 microsecond to
+# 1,000 seconds at the default accuracy of 1%.
+#
+# Error bounds
+#   Until a sketch summarizes more than exactLimit times its percentiles are exact. After that, a percentile is
+#   estimated from the middle of the bucket holding its rank, so it is within accuracy * t of the exact percentile t,
+#   plus at most 0.5 from rounding to a whole time, and never outside the smallest and largest times summarized. Times
+#   of 0 are counted exactly. The count, total and standard deviation are always exact. Merging sketches gives the same
+#   buckets as counting all of their times in one, so the bounds hold after any number of merges.
+class LatencySketch(object):
+    __slots__ = ('accuracy', 'count', 'total', 'sumOfSquares', 'minimum', 'maximum', 'times', 'buckets', 'firstBucket', 'zeroCount')
+
+    defaultAccuracy = 0.01
+    exactLimit = 512
+
+    def __init__(self, accuracy=defaultAccuracy):
+        self.accuracy = accuracy
+        self.count = 0
+        self.total = 0
+        self.sumOfSquares = 0
+        self.minimum = None
+        self.maximum = None
+        self.times = array.array('l')
+        self.buckets = None # Counts of bucket firstBucket + i, once the times are no longer kept
+        self.firstBucket = 0
+        self.zeroCount = 0
+
+    def __len__(self):
+        return self.count
+
+    def getLogGamma(self):
+        return math.log((1 + self.accuracy) / (1 - self.accuracy))
+
+    def append(self, time):
+        self.count += 1
+        self.total += time
+        self.sumOfSquares += time * time
+        if self.minimum is None or time < self.minimum:
+            self.minimum = time
+        if self.maximum is None or time > self.maximum:
+            self.maximum = time
+
+        if self.buckets is None:
+            self.times.append(time)
+            if len(self.times) > LatencySketch.exactLimit:
+                self.countTimes()
+        else:
+            self.countTime(time, 1, self.getLogGamma())
+
+    # Moves the kept times into buckets
+    def countTimes(self):
+        self.buckets = array.array('l')
+        logGamma = self.getLogGamma()
+        for time in self.times:
+            self.countTime(time, 1, logGamma)
+        self.times = array.array('l')
+
+    def countTime(self, time, count, logGamma):
+        if time <= 0:
+            self.zeroCount += count
+        else:
+            self.addToBucket(int(math.ceil(math.log(time) / logGamma)), count)
+
+    def addToBucket(self, bucket, count):
+        if not self.buckets:
+            self.firstBucket = bucket
+            self.buckets.append(0)
+        elif bucket < self.firstBucket:
+            self.buckets[0:0] = array.array('l', [0] * (self.firstBucket - bucket))
+            self.firstBucket = bucket
+        elif bucket >= self.firstBucket + len(self.buckets):
+            self.buckets.extend([0] * (bucket - self.firstBucket - len(self.buckets) + 1))
+        self.buckets[bucket - self.firstBucket] += count
+
+    # Merges another sketch, so that Instant.merge is the same for sketches and lists of times
+    def __iadd__(self, other):
+        if other.accuracy != self.accuracy:
+            raise ValueError("Unable to merge sketches of %g and %g accuracy" % (self.accuracy, other.accuracy))
+        elif not other.count:
+            return self
+
+        self.count += other.count
+        self.total += other.total
+        self.sumOfSquares += other.sumOfSquares
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+
+        if self.buckets is None and other.buckets is None:
+            self.times.extend(other.times)
+            if len(self.times) > LatencySketch.exactLimit:
+                self.countTimes()
+            return self
+
+        if self.buckets is None:
+            self.countTimes()
+
+        if other.buckets is None:
+            logGamma = self.getLogGamma()
+            for time in other.times:
+                self.countTime(time, 1, logGamma)
+        else:
+            self.zeroCount += other.zeroCount
+            for i, count in enumerate(other.buckets):
+                if count:
+                    self.addToBucket(other.firstBucket + i, count)
+        return self
+
+    # Returns the time at the same rank as times[int(len(times) * percentile)] of the sorted times
+    def getPercentile(self, percentile):
+        if not self.count:
+            return 0
+
+        rank = min(int(self.count * percentile), self.count - 1)
+        if self.buckets is None:
+            return sorted(self.times)[rank]
+
+        rank -= self.zeroCount
+        if rank < 0:
+            return 0
+
+        for i, count in enumerate(self.buckets):
+            rank -= count
+            if rank < 0:
+                gamma = math.exp(self.getLogGamma())
+                time = int(round(2 * gamma ** (self.firstBucket + i) / (gamma + 1)))
+                return max(self.minimum, min(self.maximum, time))
+
+    def getStdDev(self):
+        if not self.count:
+            return 0
+
+        # Integer arithmetic, so the variance doesn't lose precision to cancellation
+        return math.sqrt(float(self.count * self.sumOfSquares - self.total * self.total) / self.count ** 2)
@@ -1,67 +1,62 @@
 #!/usr/bin/python
+import bisect
 import datetime
 
 from instant import Instant
 
-class Stats:
-
+# The Instants of one resolution by date. The dates are also kept in order, so a range of Instants is found by bisection
+# rather than by scanning and sorting them all. Dates almost always arrive in order; when one doesn't, the dates are
+# sorted again before the next range lookup.
+class TimeIndex:
     def __init__(self):
-        self.minutes = {}
-        self.hours = {}
-        self.days = {}
+        self.instants = {}
+        self.dates = []
+        self.isSorted = True
+
+    def get(self, date):
+        instant = self.instants.get(date)
+        if instant is None:
+            instant = self.instants[date] = Instant(date)
+            if self.dates and date < self.dates[-1]:
+                self.isSorted = False
+            self.dates.append(date)
+        return instant
+
+    # Adds an Instant computed elsewhere
+    def add(self, instant):
+        date = instant.getDate()
+        if self.dates and date < self.dates[-1]:
+            self.isSorted = False
+        if not date in self.instants:
+            self.dates.append(date)
+        self.instants[date] = instant
+
+    # Returns the Instants from startDate up to but excluding stopDate in order. A missing date leaves the range open.
+    def getRange(self, startDate, stopDate):
+        if not self.isSorted:
+            self.dates.sort()
+            self.isSorted = True
+
+        start = bisect.bisect_left(self.dates, startDate) if startDate else 0
+        stop = bisect.bisect_left(self.dates, stopDate) if stopDate else len(self.dates)
+        return [self.instants[d] for d in self.dates[start:stop]]
+
+    def values(self):
+        return self.instants.values()
+
+    def __len__(self):
+        return len(self.instants)
+
+# The stats of a time range, by minute, hour and day, and of each node, as they're printed and plotted. Subclasses
+# aggregate the minutes and provide the hours and days through getHourIndex and getDayIndex.
+class StatsView:
+
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.hours = None
+        self.days = None
         self.nodes = {}
 
-    def agg(self, transaction):
-        # Get keys
-        minute = datetime.datetime(transaction.date.year, transaction.date.month, transaction.date.day, transaction.date.hour, transaction.date.minute)
-        hour = datetime.datetime(transaction.date.year, transaction.date.month, transaction.date.day, transaction.date.hour)
-        day = Stats.getStartDate(transaction.date, datetime.timedelta(1))
-
-        # Update stats
-        if not minute in self.minutes:
-            self.minutes[minute] = Instant(minute)
-        instant = self.minutes[minute]
-        instant.update(transaction)
-
-        if not hour in self.hours:
-            self.hours[hour] = Instant(hour)
-        instant = self.hours[hour]
-        instant.update(transaction)
-
-        if not day in self.days:
-            self.days[day] = Instant(day)
-        instant = self.days[day]
-        instant.update(transaction)
-
-    def aggNode(self, node, stats):
-        if not node in self.nodes:
-            for minute in stats.getAllMinutes():
-                self.aggMinute(minute)
-
-            self.nodes[node] = stats
-
-    def aggMinute(self, minute):
-        # Get keys
-        minuteKey = minute.getDate()
-        hourKey = datetime.datetime(minute.getDate().year, minute.getDate().month, minute.getDate().day, minute.getDate().hour)
-        dayKey = datetime.datetime(minute.getDate().year, minute.getDate().month, minute.getDate().day)
-
-        # Update stats
-        if not minuteKey in self.minutes:
-            self.minutes[minuteKey] = Instant(minuteKey)
-        instant = self.minutes[minuteKey]
-        instant.merge(minute)
-
-        if not hourKey in self.hours:
-            self.hours[hourKey] = Instant(hourKey)
-        instant = self.hours[hourKey]
-        instant.merge(minute)
-
-        if not dayKey in self.days:
-            self.days[dayKey] = Instant(dayKey)
-        instant = self.days[dayKey]
-        instant.merge(minute)
-
     def getNode(self, node):
         return self.nodes[node]
 
@@ -69,10 +64,10 @@ class Stats:
         return self.nodes
 
     def getPeakHour(self):
-        return max(self.hours.values(), key=lambda x: x.getPageviewCount()).getDate()
+        return max(self.getHourIndex().getRange(None, None), key=lambda x: x.getPageviewCount()).getDate()
 
     def getPeakDay(self):
-        return max(self.days.values(), key=lambda x: x.getPageviewCount()).getDate()
+        return max(self.getDayIndex().getRange(None, None), key=lambda x: x.getPageviewCount()).getDate()
 
     def getPeakHours(self, count):
         peakHour = self.getPeakHour()
@@ -82,17 +77,10 @@ class Stats:
         return self.getHours(minHour, maxHour)
 
     def getHours(self, startDateTime, stopDateTime):
-        selectHours = []
+        startHour = StatsView.getStartDate(startDateTime, datetime.timedelta(hours=1)) if startDateTime else None
+        stopHour = StatsView.getStopDate(stopDateTime, datetime.timedelta(hours=1)) if stopDateTime else None
 
-        startHour = Stats.getStartDate(startDateTime, datetime.timedelta(hours=1)) if startDateTime else None
-        stopHour = Stats.getStopDate(stopDateTime, datetime.timedelta(hours=1)) if stopDateTime else None
-
-        for hour in self.hours.values():
-            if (not startHour or hour.getDate() >= startHour) and (not stopHour or hour.getDate() < stopHour):
-                    selectHours.append(hour)
-
-        selectHours.sort(key=lambda x: x.getDate())
-        return selectHours
+        return self.getHourIndex().getRange(startHour, stopHour)
 
     def getPeakDays(self, count):
         peakDay = self.getPeakDay()
@@ -102,27 +90,13 @@ class Stats:
         return self.getDays(minDay, maxDay)
 
     def getDays(self, startDateTime, stopDateTime):
-        selectDays = []
-
-        startDay = Stats.getStartDate(startDateTime, datetime.timedelta(1)) if startDateTime else None
-        stopDay = Stats.getStopDate(stopDateTime, datetime.timedelta(1)) if stopDateTime else None
+        startDay = StatsView.getStartDate(startDateTime, datetime.timedelta(1)) if startDateTime else None
+        stopDay = StatsView.getStopDate(stopDateTime, datetime.timedelta(1)) if stopDateTime else None
 
-        for day in self.days.values():
-            if (not startDay or day.getDate() >= startDay) and (not stopDay or day.getDate() < stopDay):
-                selectDays.append(day)
-
-        selectDays.sort(key=lambda x: x.getDate())
-        return selectDays
+        return self.getDayIndex().getRange(startDay, stopDay)
 
     def getMinutes(self, startDate, stopDate):
-        selectMinutes = []
-
-        for minute in self.minutes.values():
-            if minute.getDate() >= startDate and minute.getDate() < stopDate:
-                    selectMinutes.append(minute)
-
-        selectMinutes.sort(key=lambda x: x.getDate())
-        return selectMinutes
+        return self.minutes.getRange(startDate, stopDate)
 
     def getAllMinutes(self):
         return self.minutes.values()
@@ -141,8 +115,52 @@ class Stats:
 
     @staticmethod
     def getStopDate(dt, resolution):
-        startDate = Stats.getStartDate(dt, resolution)
+        startDate = StatsView.getStartDate(dt, resolution)
         if dt > startDate:
             return startDate + resolution
         else:
             return startDate
+
+# Transactions are only aggregated by the minute. The hours and days are rolled up from the minutes when they're first
+# needed and kept until more transactions are aggregated.
+class Stats(StatsView):
+
+    def __init__(self):
+        StatsView.__init__(self, TimeIndex())
+
+    def agg(self, transaction):
+        # Get keys
+        minute = datetime.datetime(transaction.date.year, transaction.date.month, transaction.date.day, transaction.date.hour, transaction.date.minute)
+
+        # Update stats
+        self.minutes.get(minute).update(transaction)
+        self.hours = self.days = None
+
+    def aggNode(self, node, stats):
+        if not node in self.nodes:
+            for minute in stats.getAllMinutes():
+                self.aggMinute(minute)
+
+            self.nodes[node] = stats
+
+    def aggMinute(self, minute):
+        self.minutes.get(minute.getDate()).merge(minute)
+        self.hours = self.days = None
+
+    def getHourIndex(self):
+        if self.hours is None:
+            self.hours = Stats.rollUp(self.minutes, lambda d: datetime.datetime(d.year, d.month, d.day, d.hour))
+        return self.hours
+
+    def getDayIndex(self):
+        if self.days is None:
+            self.days = Stats.rollUp(self.getHourIndex(), lambda d: datetime.datetime(d.year, d.month, d.day))
+        return self.days
+
+    # Merges the Instants of a TimeIndex into an index of a coarser resolution, whose dates are given by truncate
+    @staticmethod
+    def rollUp(timeIndex, truncate):
+        rolledUp = TimeIndex()
+        for instant in timeIndex.getRange(None, None):
+            rolledUp.get(truncate(instant.getDate())).merge(instant)
+        return rolledUp
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+import json
+import os
+import time
+
+# The wall and CPU time a process spends in each stage of the pipeline. The process is always in exactly one stage; each
+# switch charges the time since the last one to the stage being left, so nested stages, such as reading the lines a
+# parser asks for, aren't counted twice. CPU time is that of the whole process, including threads that run alongside the
+# stage, such as the decompressing thread of a log reader.
+class StageTimes:
+    def __init__(self, stage):
+        self.stage = stage
+        self.wall = {}
+        self.cpu = {}
+        self.bytes = 0
+        self.lastWall = time.time()
+        self.lastCPU = time.clock()
+
+    # Starts timing a stage and returns the one that was being timed
+    def switch(self, stage):
+        now = time.time()
+        cpu = time.clock()
+        previous = self.stage
+        self.wall[previous] = self.wall.get(previous, 0) + now - self.lastWall
+        self.cpu[previous] = self.cpu.get(previous, 0) + cpu - self.lastCPU
+        self.stage = stage
+        self.lastWall = now
+        self.lastCPU = cpu
+        return previous
+
+    # Yields the items of an iterator, charging the time spent getting each one to the stage
+    def timed(self, stage, iterator):
+        iterator = iter(iterator)
+        while True:
+            previous = self.switch(stage)
+            try:
+                item = iterator.next()
+            finally:
+                self.switch(previous)
+            yield item
+
+    # Yields the lines of a log file, charging the time spent reading them to the read stage and counting their bytes
+    def timedLines(self, lines):
+        for line in self.timed('read', lines):
+            self.bytes += len(line)
+            yield line
+
+    def getStages(self):
+        self.switch(self.stage)
+        return dict((s, {'wall': self.wall[s], 'cpu': self.cpu[s]}) for s in self.wall)
+
+# The stages of the log readers and of the aggregator, what each log reader read and samples of the depth of the
+# transaction queue. Log reader stages are summed over the log readers, so their wall times can add up to more than the
+# elapsed time.
+class PipelineProfile:
+    fileName = "profile.json"
+
+    # The stages in the order they're reported, with their descriptions
+    readerStages = [('read', "read and decompress")
+        , ('parse', "parse")
+        , ('filter', "filter and batch")
+        , ('pickle', "pickle or pack batches")
+        , ('send', "send batches")
+    ]
+    aggregatorStages = [('setup', "find and seek the logs")
+        , ('wait', "wait for batches (idle)")
+        , ('unpickle', "unpickle or unpack batches")
+        , ('aggregate', "aggregate the stats")
+        , ('tree', "build the request tree")
+        , ('plot', "write the plot data")
+    ]
+    sampleInterval = 1 # Seconds between the queue depth samples kept for the report
+
+    def __init__(self):
+        self.start = time.time()
+        self.startCPU = time.clock()
+        self.aggregator = StageTimes('setup')
+        self.workers = []
+        self.depthSamples = []
+        self.depthMax = 0
+        self.depthTotal = 0
+        self.depthCount = 0
+
+    def switch(self, stage):
+        return self.aggregator.switch(stage)
+
+    def addWorker(self, worker):
+        self.workers.append(worker)
+
+    # qsize isn't implemented on every platform
+    def sampleQueueDepth(self, queue):
+        try:
+            depth = queue.qsize()
+        except NotImplementedError:
+            return
+
+        self.depthMax = max(self.depthMax, depth)
+        self.depthTotal += depth
+        self.depthCount += 1
+
+        elapsed = time.time() - self.start
+        if not self.depthSamples or elapsed - self.depthSamples[-1][0] >= PipelineProfile.sampleInterval:
+            self.depthSamples.append((round(elapsed, 3), depth))
+
+    def finish(self):
+        self.aggregator.switch('done')
+        self.wall = time.time() - self.start
+        self.cpu = time.clock() - self.startCPU
+
+    def getReport(self):
+        readerStages = {}
+        for worker in self.workers:
+            for stage, times in worker['stages'].items():
+                totals = readerStages.setdefault(stage, {'wall': 0, 'cpu': 0})
+                totals['wall'] += times['wall']
+                totals['cpu'] += times['cpu']
+
+        aggregatorStages = self.aggregator.getStages()
+        aggregatorStages.pop('done', None)
+
+        return {'wall': self.wall
+            , 'cpu': self.cpu
+            , 'lines': sum([w['lines'] for w in self.workers])
+            , 'bytes': sum([w['bytes'] for w in self.workers])
+            , 'readerStages': readerStages
+            , 'aggregatorStages': aggregatorStages
+            , 'idle': aggregatorStages.get('wait', {}).get('wall', 0)
+            , 'workers': self.workers
+            , 'queueDepth': {'max': self.depthMax, 'mean': float(self.depthTotal) / self.depthCount if self.depthCount else 0, 'samples': self.depthSamples}
+        }
+
+    def write(self, workDir):
+        with open(os.path.join(workDir, PipelineProfile.fileName), "w") as profileFileHandle:
+            json.dump(self.getReport(), profileFileHandle, indent=4, separators=(",", ": "), sort_keys=True)
+
+    def printReport(self):
+        report = self.getReport()
+
+        print
+        print "%-36s %10s %10s" % ("Stage", "Wall (s)", "CPU (s)")
+        for title, stages, descriptions in [("Log readers (%d)" % len(self.workers), report['readerStages'], PipelineProfile.readerStages)
+                , ("Aggregator", report['aggregatorStages'], PipelineProfile.aggregatorStages)]:
+            print title
+            for stage, description in descriptions:
+                if stage in stages:
+                    print "  %-34s %10.2f %10.2f" % (description, stages[stage]['wall'], stages[stage]['cpu'])
+        print "%-36s %10.2f %10.2f" % ("End to end", report['wall'], report['cpu'])
+
+        print
+        print "%-8s %7s %12s %10s %10s %10s %14s" % ("Reader", "Ranges", "Lines", "MB", "Wall (s)", "CPU (s)", "Lines/s")
+        for worker in self.workers:
+            print "%-8d %7d %12s %10.1f %10.2f %10.2f %14s" % (worker['pid'], worker['ranges'], "{:,}".format(worker['lines']), worker['bytes'] / 1048576., worker['wall'], worker['cpu'], "{:,}".format(int(worker['lines'] / worker['wall']) if worker['wall'] else 0))
+
+        print
+        print "%s lines in %.2f s (%s per second)" % ("{:,}".format(report['lines']), report['wall'], "{:,}".format(int(report['lines'] / report['wall']) if report['wall'] else 0))
+        print "Aggregator idle for %.2f s (%.0f%%)" % (report['idle'], 100. * report['idle'] / report['wall'] if report['wall'] else 0)
+        print "Transaction queue depth: max %d, mean %.1f batches" % (report['queueDepth']['max'], report['queueDepth']['mean'])
@@ -9,49 +9,159 @@ logFormat = onpremLogFormat
 fmtStrExpr = re.compile(r"%(?:(>?\w)|\{([\w-]+)\}\w?)")
 
 # The expressions in this map are for capturing transaction attributes, not validating them. Be careful not to make them too esclusive.
+# Quoted fields that may contain escaped quotes are matched as [^"\\]*(?:\\.[^"\\]*)*, which matches the same text as
+# (?:[^"\\]|\\.)* but consumes runs of ordinary characters at once rather than one alternation per character.
 logFormatMap = {'h': r'(?:\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|[0-9a-fA-F:]+)'
     , 'JiveClientIP': r'(?:\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|[0-9a-fA-F:]+)'
     , 'l': '-'
     , 'u': '-'
     , 'X-JIVE-USER-ID': r'-?[0-9]*'
     , 't': r'\[(?P<date>.*) [+-]\d{4}\]'
-    , 'r': r'(?P<method>[A-Z]+) (?P<path>(?:[^"\\]|\\.)*) [^"]*'
+    , 'r': r'(?P<method>[A-Z]+) (?P<path>[^"\\]*(?:\\.[^"\\]*)*) [^"]*'
     , '>s': r'(?P<status>\d{3})'
     , 'b': r'(?P<size>-|\d+)'
     , 'T': r'(?P<time>\d+)'
     , 'k': r'\d+'
-    , 'Referer': r'(?P<referer>(?:[^"\\]|\\.)*)'
-    , 'User-Agent': r'(?P<userAgent>(?:[^"\\]|\\.)*)'
+    , 'Referer': r'(?P<referer>[^"\\]*(?:\\.[^"\\]*)*)'
+    , 'User-Agent': r'(?P<userAgent>[^"\\]*(?:\\.[^"\\]*)*)'
     , 'Content-Type': '(?P<contentType>[^"]*)'
     , 'JSESSIONID': '.*'
 }
-logExpression = re.compile(fmtStrExpr.sub(lambda m: logFormatMap[m.groups()[0] or m.groups()[1]], logFormat))
+namedGroupExpr = re.compile(r"\(\?P<(\w+)>")
+
+# Returns the log expression capturing only the named fields; the groups of the others still match but capture nothing
+def getLogExpression(fields=None):
+    expression = fmtStrExpr.sub(lambda m: logFormatMap[m.groups()[0] or m.groups()[1]], logFormat)
+    if fields is not None:
+        expression = namedGroupExpr.sub(lambda m: m.group(0) if m.group(1) in fields else "(?:", expression)
+    return re.compile(expression)
+
+logExpression = getLogExpression()
+
+# Returns the log expression for scanning many log entries at once, such as a whole memory mapped log file, with finditer.
+# Each match is one whole line, starting at the start of a line, and no field can match across the end of one. Lines that
+# don't match are skipped by finditer, so a gap between the end of one match and the start of the next is of lines that
+# couldn't be parsed.
+def getScanExpression(fields=None):
+    expression = getLogExpression(fields).pattern.replace("[^", "[^\\n")
+    return re.compile("(?m)^(?:%s)[^\\n]*" % expression)
 dateFormat="%d/%b/%Y:%H:%M:%S" # Consider the timezone to be local
+months = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6, 'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+minuteCacheSize = 4096
+minuteCache = {}
 
 oldLogExpression = re.compile('^.*\[(?P<date>.*) [+-]\d{4}\] "(?P<method>[A-Z]+) (?P<path>(?:[^"\\\]|\\\.)*) [^"]*" (?P<status>\d{3}) (?P<size>-|\d*) (?P<time>\d*) \d+ "(?P<referer>(?:[^"\\\]|\\\.)*)" "(?P<userAgent>(?:[^"\\\]|\\\.)*)" "(?P<contentType>[^"]*)" .*$')
 # Example
 # 155.201.35.178 - - [12/Nov/2014:00:00:56 +0000] "GET /__services/v2/rest/apps/v1/containersecuritytoken?_=1415750456371 HTTP/1.1" 200 134 13938 0 "https://pwc-spark.com/docs/DOC-37650" "Mozilla/5.0 (compatible; MSIE 9.0; Windows NT 6.1; WOW64; Trident/5.0)" "application/json" B26F4D8E89595991C6F2D193F15776BA 13588
 
-class Transaction:
-    def __init__(self, raw, node):
-        matchedLine = logExpression.match(raw)
+# Decodes the date of the %t field, e.g. 12/Nov/2014:00:00:56, into the same datetime as strptime with dateFormat.
+# Consecutive log entries share the minute, so the minute is decoded once and only the seconds are decoded per entry.
+# Anything that isn't in the canonical form is left to strptime.
+def parseDate(date):
+    try:
+        minute = minuteCache.get(date[:18])
+        if minute is None:
+            if len(date) != 20 or date[2] != '/' or date[6] != '/' or date[11] != ':' or date[14] != ':' or date[17] != ':':
+                raise ValueError(date)
+
+            minute = datetime.datetime(int(date[7:11]), months[date[3:6]], int(date[:2]), int(date[12:14]), int(date[15:17]))
+
+            if len(minuteCache) >= minuteCacheSize:
+                minuteCache.clear()
+            minuteCache[date[:18]] = minute
+
+        return minute.replace(second=int(date[18:]))
+    except (KeyError, ValueError):
+        return datetime.datetime.strptime(date, dateFormat)
+
+def parseSize(size):
+    return 0 if size == "-" else int(size)
+
+# Returns the date of a log entry, or None if it can't be told, without matching the log expression. The %t field is the
+# first bracketed field of both log formats; the client address, identity and user ID before it never contain a '['.
+def getDate(raw):
+    start = raw.find('[')
+    if start < 0 or not raw[start + 21:start + 23] in (" +", " -"):
+        return None
+
+    try:
+        return parseDate(raw[start + 1:start + 21])
+    except ValueError:
+        return None
+
+# Returns the date of a log entry if it is outside of [startDate, stopDate), or None if it's inside or can't be told. An
+# entry without the quoted referer, user agent and content type of both log formats is malformed; None is returned so
+# that it's parsed, and counted as unparsed, however it's dated.
+def getDateOutsideRange(raw, startDate, stopDate):
+    date = getDate(raw)
+    if date and (startDate and date < startDate or stopDate and date >= stopDate) and raw.count('" "') >= 2:
+        return date
+    else:
+        return None
+
+# Parses log entries into the given transaction fields and no others; a run only parses the fields its mode and filters
+# use. The raw log entry is only kept when asked, e.g. for debugging, or when the entry couldn't be parsed.
+class LogParser:
+    def __init__(self, fields, keepRaw):
+        self.expression = getLogExpression(fields)
+        self.scanExpression = getScanExpression(fields)
+        self.fields = sorted(self.expression.groupindex, key=self.expression.groupindex.get)
+        self.converters = [LogParser.converters[f] for f in self.fields]
+        self.keepRaw = keepRaw
+
+    # The method, status and content type have few distinct values; they are interned so every transaction shares the
+    # same strings, which also lets a batch of records be pickled with one copy of each.
+    converters = {'date': parseDate
+        , 'method': intern # Changed to "sys.intern" in Python 3
+        , 'path': str # Returns the same string
+        , 'status': intern
+        , 'size': parseSize
+        , 'time': int
+        , 'userAgent': str
+        , 'contentType': intern
+    }
+
+# Millions of transactions can be alive at once, so they have slots rather than a dict. Fields that weren't parsed are
+# left unset.
+class Transaction(object):
+    __slots__ = ('date', 'method', 'path', 'status', 'size', 'time', 'userAgent', 'contentType', 'valid', 'raw', 'node')
+
+    def __init__(self, raw, node, parser=None):
+        parser = parser or fullParser
+        matchedLine = parser.expression.match(raw)
 
         if matchedLine:
-            self.date = datetime.datetime.strptime(matchedLine.group('date'), dateFormat)
-            self.method = matchedLine.group('method')
-            self.path = matchedLine.group('path')
-            self.status = matchedLine.group('status')
-            self.size = 0 if matchedLine.group('size') == "-" else int(matchedLine.group('size'))
-            self.time = int(matchedLine.group('time'))
-            self.userAgent = matchedLine.group('userAgent')
-            self.contentType = matchedLine.group('contentType')
+            for field, converter, value in zip(parser.fields, parser.converters, matchedLine.groups()):
+                setattr(self, field, converter(value))
             self.valid = True
         else:
             self.valid = False
 
-        self.raw = raw
+        self.raw = raw if parser.keepRaw or not self.valid else None
         self.node = node
 
+    # Builds a transaction from a match of a parser's scan expression
+    @classmethod
+    def fromMatch(cls, match, node, parser):
+        transaction = cls.__new__(cls)
+        for field, converter, value in zip(parser.fields, parser.converters, match.groups()):
+            setattr(transaction, field, converter(value))
+        transaction.valid = True
+        transaction.raw = match.group(0).rstrip() if parser.keepRaw else None
+        transaction.node = node
+        return transaction
+
+    # Rebuilds a transaction from a record shipped by a log reader. Only the named fields are set.
+    @classmethod
+    def fromRecord(cls, fields, record, node):
+        transaction = cls.__new__(cls)
+        transaction.raw = None
+        for field, value in zip(fields, record):
+            setattr(transaction, field, value)
+        transaction.valid = True
+        transaction.node = node
+        return transaction
+
     def isValid(self):
         return self.valid
 
@@ -82,3 +192,6 @@ class Transaction:
 
     def isWrite(self):
         return self.method in ["PUT", "DELETE"] or self.method == "POST" and self.status == "302"
+
+# Parses every field a transaction has, e.g. for the transaction cache
+fullParser = LogParser(LogParser.converters, True)